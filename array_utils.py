@@ -0,0 +1,58 @@
+import math
+
+import numpy as np
+
+
+def chunked(blocks, chunk_size: int, limit: int = None):
+    """
+    Regroup a stream of (k, 2) blocks into copies of exactly chunk_size rows, the last one may be shorter.
+
+    :param blocks: Iterable of arrays with the same number of columns.
+    :param limit: Most rows yielded in total, all of them by default.
+    """
+    pending, size = [], 0
+    left = math.inf if limit is None else limit
+    for block in blocks:
+        if left <= 0:
+            break
+        if left < len(block):
+            block = block[:left]
+        left -= len(block)
+        pending.append(block)
+        size += len(block)
+        while size >= chunk_size:
+            merged = pending[0] if len(pending) == 1 else np.concatenate(pending)
+            yield merged[:chunk_size].copy()
+            pending, size = [merged[chunk_size:]], size - chunk_size
+    if size:
+        yield np.concatenate(pending)
+
+
+def csr(query_ids: list[np.ndarray], values: list[np.ndarray], m: int,
+        empty: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Group (query, value) pairs by query.
+
+    :param query_ids: Arrays of query numbers in 0..m-1.
+    :param values: Arrays of the values matching query_ids row by row.
+    :param m: Number of queries.
+    :param empty: Values returned when there are no pairs at all, an empty int64 array by default.
+    :return: (offsets, values) in CSR form, values of query i are values[offsets[i]:offsets[i+1]],
+             in the order they were given.
+    """
+    offsets = np.zeros(m + 1, dtype=np.int64)
+    if not query_ids:
+        return offsets, np.empty(0, dtype=np.int64) if empty is None else empty
+
+    query_ids, values = np.concatenate(query_ids), np.concatenate(values)
+    np.cumsum(np.bincount(query_ids, minlength=m), out=offsets[1:])
+    return offsets, values[np.argsort(query_ids, kind='stable')]
+
+
+def as_row(query) -> tuple[float, float, float, float]:
+    """
+    (x_min, x_max, y_min, y_max) of a kdtree.rect, a quadtree.AABB or a plain 4-tuple.
+    """
+    if hasattr(query, 'x_min'):
+        return query.x_min, query.x_max, query.y_min, query.y_max
+    return tuple(query)
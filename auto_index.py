@@ -0,0 +1,145 @@
+import time
+
+import numpy as np
+
+from array_utils import as_row
+import kdtree as kd
+import quadtree as qt
+
+# most points the candidates are timed on
+AUTO_SAMPLE_SIZE = 20000
+# most sample queries timed per candidate
+AUTO_MAX_QUERIES = 200
+# node capacities / leaf sizes tried for the structures that have one
+AUTO_CAPACITIES = (1, 4, 8, 16, 32, 64)
+# cells per side of the grid the data skew is described with
+_SKEW_GRID = 32
+
+
+# name -> (takes a capacity, build(points, capacity), query(tree, row) -> list of (x, y))
+STRUCTURES = {
+    'quadtree': (True, lambda points, capacity: qt.BulkLoadQuadTree(None, capacity, points),
+                 lambda tree, row: tree.query_range(qt.AABB.from_edges(*row))),
+    'kdtree': (False, lambda points, capacity: kd.build_kd_tree(list(map(tuple, points.tolist()))),
+               lambda tree, row: kd.points_inside_rect(kd.rect(*row), tree)),
+    'kdtree_array': (True, lambda points, capacity: kd.build_kd_tree_array(points.copy(), capacity),
+                     lambda tree, row: kd.points_inside_rect(kd.rect(*row), tree)),
+}
+
+
+def _describe_data(points: np.ndarray, rows: np.ndarray) -> str:
+    # share of the grid cells over the extent holding any point, and the median query selectivity
+    extent_min, extent = points.min(axis=0), np.ptp(points, axis=0)
+    cells = np.minimum(((points - extent_min) / np.where(extent > 0, extent, 1) * _SKEW_GRID).astype(np.int64),
+                       _SKEW_GRID - 1)
+    occupied = len(np.unique(cells[:, 0] * _SKEW_GRID + cells[:, 1])) / _SKEW_GRID ** 2
+    inside = [((row[0] <= points[:, 0]) & (points[:, 0] <= row[1]) &
+               (row[2] <= points[:, 1]) & (points[:, 1] <= row[3])).mean() for row in rows]
+    return (f"points fill {occupied:.0%} of a {_SKEW_GRID}x{_SKEW_GRID} grid over their extent, "
+            f"median query selectivity {np.median(inside):.3%}")
+
+
+def _candidate_name(structure: str, capacity: int) -> str:
+    return f"{structure} (capacity {capacity})" if STRUCTURES[structure][0] else structure
+
+
+# Index picked by auto_index, answering range queries through whichever tree won
+class AutoIndex:
+    def __init__(self, tree, structure: str, capacity: int, reason: str, timings: list[dict]):
+        """
+        :param tree: The built tree.
+        :param structure: Key of STRUCTURES the tree was built with.
+        :param capacity: Node capacity / leaf size it was built with, None if the structure has none.
+        :param reason: Why this candidate was chosen.
+        :param timings: Measurements of every candidate, fastest first.
+        """
+        self.tree = tree
+        self.structure = structure
+        self.capacity = capacity
+        self.reason = reason
+        self.timings = timings
+
+    def query_range(self, query) -> list[tuple[float, float]]:
+        """
+        Find all points within a rectangle.
+
+        :param query: kdtree.rect, quadtree.AABB or (x_min, x_max, y_min, y_max).
+        """
+        return STRUCTURES[self.structure][2](self.tree, as_row(query))
+
+    def __repr__(self):
+        return f"AutoIndex({_candidate_name(self.structure, self.capacity)})"
+
+
+def auto_index(points: np.ndarray, sample_queries, expected_queries: int = None, capacities=AUTO_CAPACITIES,
+               structures=tuple(STRUCTURES), sample_size: int = AUTO_SAMPLE_SIZE, seed: int = 0) -> AutoIndex:
+    """
+    Build the structure and capacity predicted to answer queries like sample_queries fastest.
+    Every candidate is built over a random subsample of the points and timed on the sample
+    queries, the winner is then built over all points.
+
+    :param points: (N, 2) array.
+    :param sample_queries: Rectangles typical for the expected traffic, see AutoIndex.query_range.
+    :param expected_queries: Queries the index will answer, spreads the build time over them when
+                             ranking. By default only query time counts.
+    :param capacities: Node capacities / leaf sizes tried.
+    :param structures: Keys of STRUCTURES tried.
+    :param sample_size: Most points the candidates are built over.
+    :param seed: Seed of the subsample.
+    """
+    points = np.asarray(points, dtype=np.float64)[:, :2]
+    rows = np.array([as_row(query) for query in sample_queries], dtype=np.float64).reshape(-1, 4)
+    if not len(points) or not len(rows):
+        raise ValueError("auto_index needs points and at least one sample query")
+
+    rng = np.random.default_rng(seed)
+    sample = points if len(points) <= sample_size else points[rng.choice(len(points), sample_size, replace=False)]
+    timed_rows = rows if len(rows) <= AUTO_MAX_QUERIES else rows[rng.choice(len(rows), AUTO_MAX_QUERIES, replace=False)]
+    timed_rows = [tuple(row) for row in timed_rows.tolist()]
+
+    timings = []
+    for structure in structures:
+        takes_capacity, build, query = STRUCTURES[structure]
+        for capacity in (capacities if takes_capacity else (None,)):
+            start = time.perf_counter()
+            try:
+                tree = build(sample, capacity)
+            except RecursionError:
+                # the recursive object KD-tree build cannot split long runs of equal coordinates
+                continue
+            build_s = time.perf_counter() - start
+
+            # warm-up pass, then the median of three timed passes
+            for row in timed_rows:
+                query(tree, row)
+            passes = []
+            for _ in range(3):
+                start = time.perf_counter()
+                for row in timed_rows:
+                    query(tree, row)
+                passes.append((time.perf_counter() - start) / len(timed_rows))
+
+            query_s = float(np.median(passes))
+            # build time grows about linearly with the number of points
+            build_full_s = build_s * len(points) / len(sample)
+            cost = query_s + (build_full_s / expected_queries if expected_queries else 0.0)
+            timings.append({'structure': structure, 'capacity': capacity, 'build_s': build_full_s,
+                            'query_s': query_s, 'cost': cost})
+
+    if not timings:
+        raise ValueError("no candidate structure could be built over these points")
+
+    timings.sort(key=lambda timing: timing['cost'])
+    best = timings[0]
+    reason = (f"{_candidate_name(best['structure'], best['capacity'])} answered the sample queries in "
+              f"{best['query_s'] * 1e6:.1f}us each over a {len(sample)} point subsample")
+    if expected_queries:
+        reason += f", {best['build_s']:.3f}s estimated build spread over {expected_queries} queries"
+    if len(timings) > 1:
+        runner_up = timings[1]
+        reason += (f", {runner_up['cost'] / best['cost']:.2f}x ahead of "
+                   f"{_candidate_name(runner_up['structure'], runner_up['capacity'])}")
+    reason += f"; {_describe_data(sample, rows)}"
+
+    tree = STRUCTURES[best['structure']][1](points, best['capacity'])
+    return AutoIndex(tree, best['structure'], best['capacity'], reason, timings)
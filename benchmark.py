@@ -0,0 +1,260 @@
+import argparse
+import csv
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import datasets
+import kdtree as kd
+import quadtree as qt
+from query_stats import QueryStats
+import workload
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_CAPACITIES = [1, 4, 32]
+DEFAULT_REPEATS = 5
+DEFAULT_QUERIES = 100
+DEFAULT_WORKLOADS = ['small', 'large', 'mixed']
+DEFAULT_SEED = 12345
+# relative slowdown compare reports as a regression
+DEFAULT_THRESHOLD = 0.10
+# metrics compare looks at, all of them lower is better
+COMPARED_METRICS = ['build_median_s', 'query_median_s', 'peak_memory_bytes']
+
+
+def _as_tuples(points: np.ndarray) -> list[tuple[float, float]]:
+    return list(map(tuple, points.tolist()))
+
+
+# name -> (prepare(points) -> build input, build(input, capacity),
+#          query(tree, (x_min, x_max, y_min, y_max), stats=None) -> match count,
+#          shape(tree) -> query_stats.shape_summary dict)
+# prepare runs before every build outside the timed and traced region, so input conversions
+# and the copy the in-place array build needs are not charged to any structure.
+STRUCTURES = {
+    'quadtree': (
+        _as_tuples,
+        lambda points, capacity: qt.BuildQuadTree(None, capacity, points, robust=True),
+        lambda tree, query, stats=None: len(tree.query_range(qt.AABB.from_edges(*query), stats)),
+        qt.QuadTree.shape_stats,
+    ),
+    'quadtree_bulk': (
+        lambda points: points,
+        lambda points, capacity: qt.BulkLoadQuadTree(None, capacity, points),
+        lambda tree, query, stats=None: len(tree.query_range(qt.AABB.from_edges(*query), stats)),
+        qt.QuadTree.shape_stats,
+    ),
+    'kdtree': (
+        _as_tuples,
+        lambda points, capacity: kd.build_kd_tree(points),
+        lambda tree, query, stats=None: len(kd.points_inside_rect(kd.rect(*query), tree, stats)),
+        kd.kd_tree_shape,
+    ),
+    'kdtree_array': (
+        np.copy,
+        lambda points, capacity: kd.build_kd_tree_array(points, capacity),
+        lambda tree, query, stats=None: (len(kd.points_inside_rect_np(kd.rect(*query), tree)) if stats is None else
+                                         len(kd.points_inside_rect(kd.rect(*query), tree, stats))),
+        kd.kd_tree_shape,
+    ),
+}
+
+
+def _median_iqr(values: list[float]) -> tuple[float, float]:
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    return float(median), float(q3 - q1)
+
+
+def run_case(dataset: str, structure: str, n: int, capacity: int, repeats: int = DEFAULT_REPEATS,
+             workload_name: str = 'small', queries: np.ndarray = None, seed: int = DEFAULT_SEED) -> dict:
+    """
+    Benchmark building one structure and querying it.
+
+    :param workload_name: Key of workload.WORKLOADS, recorded with the results.
+    :param queries: (Q, 4) rectangles, by default DEFAULT_QUERIES generated from the workload.
+    :return: One result record, times in seconds, query times per query.
+    """
+    prepare, build, query, shape = STRUCTURES[structure]
+    points = datasets.generate(dataset, n, seed)
+    if queries is None:
+        queries = workload.generate(workload_name, points, DEFAULT_QUERIES, seed + 1)
+    rows = [tuple(row) for row in np.asarray(queries).tolist()]
+
+    # peak memory in a run of its own, tracing slows everything down
+    build_input = prepare(points)
+    gc.collect()
+    tracemalloc.start()
+    tree = build(build_input, capacity)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    build_times = []
+    for _ in range(repeats):
+        tree, build_input = None, prepare(points)
+        gc.collect()
+        start = time.perf_counter()
+        tree = build(build_input, capacity)
+        build_times.append(time.perf_counter() - start)
+
+    # warm-up pass, then every repeat times all queries
+    matches = [query(tree, row) for row in rows]
+    query_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for row in rows:
+            query(tree, row)
+        query_times.append((time.perf_counter() - start) / max(len(rows), 1))
+
+    # traversal counters in a pass of their own, outside the timed ones
+    stats = QueryStats(keep_queries=False)
+    for row in rows:
+        query(tree, row, stats)
+    counters, tree_shape = stats.summary(), shape(tree)
+
+    build_median, build_iqr = _median_iqr(build_times)
+    query_median, query_iqr = _median_iqr(query_times)
+    return {
+        'dataset': dataset, 'workload': workload_name, 'structure': structure, 'n': n, 'capacity': capacity,
+        'repeats': repeats, 'queries': len(rows), 'seed': seed,
+        'build_median_s': build_median, 'build_iqr_s': build_iqr,
+        'query_median_s': query_median, 'query_iqr_s': query_iqr,
+        'peak_memory_bytes': int(peak_memory),
+        'nodes_visited': counters['mean_nodes_visited'],
+        'box_tests': counters['mean_box_tests'],
+        'points_tested': counters['mean_points_tested'],
+        'pruning_efficiency': counters['pruning_efficiency'],
+        'tree_nodes': tree_shape['nodes'],
+        'max_depth': tree_shape['max_depth'],
+        'empty_leaves': tree_shape['empty_leaves'],
+        'leaf_fill': tree_shape['leaf_fill'],
+        'matches': int(sum(matches)),
+        'selectivity': sum(matches) / (n * len(rows)) if rows else 0.0,
+    }
+
+
+def run(dataset_names: list[str], structures: list[str], sizes: list[int], capacities: list[int],
+        repeats: int = DEFAULT_REPEATS, query_count: int = DEFAULT_QUERIES, seed: int = DEFAULT_SEED,
+        workload_names: list[str] = DEFAULT_WORKLOADS) -> dict:
+    """
+    Run every combination of dataset, workload, structure, size and capacity. All structures
+    of one dataset, workload and size see the same points and the same queries.
+
+    :return: {'meta': environment and settings, 'results': list of run_case records}
+    """
+    results = []
+    for dataset in dataset_names:
+        for n in sizes:
+            points = datasets.generate(dataset, n, seed)
+            for workload_name in workload_names:
+                queries = workload.generate(workload_name, points, query_count, seed + 1)
+                for capacity in capacities:
+                    for structure in structures:
+                        try:
+                            record = run_case(dataset, structure, n, capacity, repeats, workload_name, queries, seed)
+                        except RecursionError:
+                            # the recursive object KD-tree build cannot split long runs of equal coordinates
+                            print(f"{dataset:>9} {workload_name:>6} {structure:>13} n={n:<8} cap={capacity:<4} "
+                                  f"skipped, recursion too deep", file=sys.stderr)
+                            continue
+                        print(f"{dataset:>9} {workload_name:>6} {structure:>13} n={n:<8} cap={capacity:<4} "
+                              f"build={record['build_median_s']:.4f}s query={record['query_median_s'] * 1e6:.1f}us "
+                              f"visited={record['nodes_visited']:.1f}", file=sys.stderr)
+                        results.append(record)
+
+    meta = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seed': seed, 'repeats': repeats, 'queries': query_count}
+    return {'meta': meta, 'results': results}
+
+
+def write_json(report: dict, path: str) -> None:
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2)
+
+
+def write_csv(report: dict, path: str) -> None:
+    results = report['results']
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(results[0]) if results else [])
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def compare(old: dict, new: dict, threshold: float = DEFAULT_THRESHOLD) -> list[dict]:
+    """
+    Find cases that got worse between two reports. A metric regresses when it grew by more
+    than threshold and by more than the spread (IQR) measured in both runs.
+
+    :return: One record per regressed metric.
+    """
+    def key(record):
+        return record['dataset'], record.get('workload'), record['structure'], record['n'], record['capacity']
+
+    before = {key(record): record for record in old['results']}
+    regressions = []
+    for record in new['results']:
+        previous = before.get(key(record))
+        if previous is None:
+            continue
+        for metric in COMPARED_METRICS:
+            was, now = previous[metric], record[metric]
+            spread_metric = metric.replace('median', 'iqr')
+            noise = previous.get(spread_metric, 0) + record.get(spread_metric, 0) if spread_metric != metric else 0
+            if was > 0 and now > was * (1 + threshold) and now - was > noise:
+                regressions.append(dict(zip(('dataset', 'workload', 'structure', 'n', 'capacity'), key(record)),
+                                        metric=metric, old=was, new=now, change=now / was - 1))
+
+    return regressions
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark QuadTree and KDTree builds and range queries")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="run the benchmark grid")
+    run_parser.add_argument('--datasets', nargs='+', default=list(datasets.DATASETS), choices=list(datasets.DATASETS))
+    run_parser.add_argument('--workloads', nargs='+', default=DEFAULT_WORKLOADS, choices=list(workload.WORKLOADS))
+    run_parser.add_argument('--structures', nargs='+', default=list(STRUCTURES), choices=list(STRUCTURES))
+    run_parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES)
+    run_parser.add_argument('--capacities', nargs='+', type=int, default=DEFAULT_CAPACITIES)
+    run_parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    run_parser.add_argument('--queries', type=int, default=DEFAULT_QUERIES)
+    run_parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    run_parser.add_argument('--json', help="write results as JSON")
+    run_parser.add_argument('--csv', help="write results as CSV")
+
+    compare_parser = commands.add_parser('compare', help="flag regressions between two JSON results")
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        report = run(args.datasets, args.structures, args.sizes, args.capacities, args.repeats, args.queries, args.seed,
+                     args.workloads)
+        if args.json:
+            write_json(report, args.json)
+        if args.csv:
+            write_csv(report, args.csv)
+        if not args.json and not args.csv:
+            json.dump(report, sys.stdout, indent=2)
+        return 0
+
+    with open(args.old) as file:
+        old = json.load(file)
+    with open(args.new) as file:
+        new = json.load(file)
+    regressions = compare(old, new, args.threshold)
+    for r in regressions:
+        print(f"REGRESSION {r['dataset']} {r['workload']} {r['structure']} n={r['n']} cap={r['capacity']} "
+              f"{r['metric']}: {r['old']:.6g} -> {r['new']:.6g} ({r['change']:+.1%})")
+    print(f"{len(regressions)} regression(s)")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+import math
+import sys
+from collections import OrderedDict
+
+import kdtree as kd
+from quadtree import AABB
+
+# approximate bytes held by one cached (x, y) tuple and its two floats
+_POINT_BYTES = sys.getsizeof((0.0, 0.0)) + 2 * sys.getsizeof(0.0)
+
+
+# LRU cache of range query results in front of a tree
+# Entries are keyed on the rectangle's edges snapped outwards to a grid of size quantum (exact
+# edges when quantum is 0). An entry holds the points of the snapped rectangle, a superset shared
+# by every rectangle with the same key, which is filtered down to the asked rectangle on every
+# hit and miss. Updates made through the cache drop only the entries whose snapped rectangle
+# contains the changed point.
+class QueryCache:
+    def __init__(self, tree, quantum: float = 0.0, max_entries: int = 1024, max_bytes: int = 64 * 2 ** 20):
+        """
+        :param tree: QuadTree, FlatQuadTree, LinearQuadTree, kd_tree_node, kd_tree_array or dynamic_kd_tree.
+        :param quantum: Grid the rectangle edges are snapped outwards to before querying, 0 keeps them exact.
+                        Results are always those of the exact rectangle.
+        :param max_entries: Most results kept at once.
+        :param max_bytes: Most bytes of results kept at once, estimated from the point counts.
+        """
+        self.tree = tree
+        self.quantum = quantum
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        # key -> (query, result, bytes), least recently used first
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _key(self, query) -> tuple:
+        # AABB and kdtree.rect both carry their edges
+        edges = (query.x_min, query.x_max, query.y_min, query.y_max)
+        if self.quantum:
+            x_min, x_max, y_min, y_max = edges
+            edges = (self._snap(x_min, math.floor), self._snap(x_max, math.ceil),
+                     self._snap(y_min, math.floor), self._snap(y_max, math.ceil))
+
+        return (type(query),) + edges
+
+    def _snap(self, edge: float, direction) -> float:
+        # grid line at or beyond edge, checked after multiplying as edge / quantum may round across it
+        step = -1 if direction is math.floor else 1
+        k = direction(edge / self.quantum)
+        while (k * self.quantum - edge) * step < 0:
+            k += step
+        return k * self.quantum
+
+    def _run(self, query, key: tuple) -> tuple[object, list[tuple[float, float]]]:
+        if self.quantum:
+            # answer the snapped rectangle, which holds every rectangle sharing the key
+            x_min, x_max, y_min, y_max = key[1:]
+            query = (AABB.from_edges(x_min, x_max, y_min, y_max) if isinstance(query, AABB)
+                     else kd.rect(x_min, x_max, y_min, y_max))
+
+        if isinstance(query, AABB):
+            result = self.tree.query_range(query)
+        elif isinstance(self.tree, kd.dynamic_kd_tree):
+            result = self.tree.points_inside_rect(query)
+        else:
+            result = kd.points_inside_rect(query, self.tree)
+
+        return query, result
+
+    def query_range(self, query) -> list[tuple[float, float]]:
+        """
+        Find all points within a box, from the cache when it was asked before.
+
+        :param query: quadtree.AABB for QuadTree like trees, kdtree.rect for kd trees.
+        :return: A new list of the points, callers may change it freely.
+        """
+        key = self._key(query)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._within(query, entry[1])
+
+        self.misses += 1
+        snapped, result = self._run(query, key)
+        size = sys.getsizeof(result) + len(result) * _POINT_BYTES
+        if size <= self.max_bytes:
+            self._entries[key] = (snapped, result, size)
+            self.nbytes += size
+            while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+                self.nbytes -= self._entries.popitem(last=False)[1][2]
+                self.evictions += 1
+
+        return self._within(query, result)
+
+    def _within(self, query, result: list[tuple[float, float]]) -> list[tuple[float, float]]:
+        # the points of a snapped rectangle's result that lie in the rectangle actually asked for
+        if not self.quantum:
+            return list(result)
+        if isinstance(query, AABB):
+            return [point for point in result if query.contains_point(point)]
+        return [point for point in result if query.is_inside(point)]
+
+    def invalidate(self, point: tuple[float, float]) -> int:
+        """
+        Drop the entries whose rectangle contains a point.
+
+        :return: Number of entries dropped.
+        """
+        point = (point[0], point[1])
+        stale = [key for key, (query, _, _) in self._entries.items()
+                 if (query.contains_point(point) if isinstance(query, AABB) else query.is_inside(point))]
+        for key in stale:
+            self.nbytes -= self._entries.pop(key)[2]
+        self.invalidations += len(stale)
+
+        return len(stale)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.nbytes = 0
+
+    def insert(self, point: tuple[float, float]) -> None:
+        """
+        Insert into the tree and drop the cached results the point belongs to
+        """
+        self.tree.insert(point)
+        self.invalidate(point)
+
+    def remove(self, point: tuple[float, float]) -> bool:
+        """
+        Remove from the tree (QuadTree.remove or dynamic_kd_tree.delete), see insert
+        """
+        removed = self.tree.delete(point) if isinstance(self.tree, kd.dynamic_kd_tree) else self.tree.remove(point)
+        if removed:
+            self.invalidate(point)
+
+        return removed
+
+    def move(self, old: tuple[float, float], new: tuple[float, float]) -> bool:
+        """
+        Move a point in the tree, entries containing either position are dropped
+        """
+        if not self.tree.move(old, new):
+            return False
+
+        self.invalidate(old)
+        self.invalidate(new)
+        return True
+
+    def stats(self) -> dict[str, int]:
+        """
+        Hit and miss counters and the current size of the cache
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'invalidations': self.invalidations, 'entries': len(self._entries), 'bytes': self.nbytes}
@@ -0,0 +1,56 @@
+import numpy as np
+
+# Point sets of the tests.py scenarios as seeded (N, 2) arrays, so every benchmark run
+# sees exactly the same points. Coordinates live in the same 0..100 square as in tests.py.
+
+
+def uniform(n: int, rng: np.random.Generator) -> np.ndarray:
+    return rng.uniform(0, 100, (n, 2))
+
+
+def normal(n: int, rng: np.random.Generator) -> np.ndarray:
+    # same parameters as test_normal_dist, most points fall outside the 0..100 square
+    return rng.normal(0, 100, (n, 2))
+
+
+def clusters(n: int, rng: np.random.Generator) -> np.ndarray:
+    # two dense squares in opposite corners
+    low = rng.uniform(0, 20, (n // 2, 2))
+    high = rng.uniform(80, 100, (n - n // 2, 2))
+    return np.concatenate((low, high))
+
+
+def outliers(n: int, rng: np.random.Generator) -> np.ndarray:
+    # 99% of the points in one small square, the rest anywhere
+    dense = (n * 99) // 100
+    points = np.column_stack((rng.uniform(40, 50, dense), rng.uniform(30, 40, dense)))
+    return np.concatenate((points, rng.uniform(0, 100, (n - dense, 2))))
+
+
+def cross(n: int, rng: np.random.Generator) -> np.ndarray:
+    # a horizontal and a vertical line of points, many share one coordinate
+    horizontal = np.column_stack((rng.uniform(0, 50, n // 2), np.full(n // 2, 50.0)))
+    vertical = np.column_stack((np.full(n - n // 2, 25.0), rng.uniform(0, 100, n - n // 2)))
+    return np.concatenate((horizontal, vertical))
+
+
+DATASETS = {
+    'uniform': uniform,
+    'normal': normal,
+    'clusters': clusters,
+    'outliers': outliers,
+    'cross': cross,
+}
+
+
+def generate(name: str, n: int, seed: int) -> np.ndarray:
+    """
+    Generate one of DATASETS.
+
+    :param name: Key of DATASETS.
+    :param seed: Seed of the generator, the same seed always gives the same points.
+    """
+    if name not in DATASETS:
+        raise ValueError(f"unknown dataset {name!r}, expected one of {', '.join(DATASETS)}")
+
+    return DATASETS[name](n, np.random.default_rng(seed))
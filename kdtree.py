@@ -1,4 +1,29 @@
+import heapq
+import itertools
+import math
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from array_utils import chunked, csr
+from persist import load_index, save_index
+from polygon_index import INSIDE, OUTSIDE, PolygonIndex
+from query_stats import QueryStats, shape_summary
+
+# how many points a leaf of the bucketed array tree keeps
+KD_LEAF_SIZE=32
+# points per block yielded by iter_range_chunks
+KD_CHUNK_SIZE=65536
+# smaller inputs are built serially even when workers are requested, a pool costs more than it saves
+KD_PARALLEL_MIN=100000
+# dynamic tree rebuilds a subtree once one child holds more than this share of its points
+KD_BALANCE_ALPHA=0.7
+
+
 class rect:
+    __slots__=('x_min','x_max','y_min','y_max')
+
     def __init__(self, x_min, x_max, y_min, y_max):
         self.x_min=x_min
         self.x_max=x_max
@@ -13,6 +38,12 @@ class rect:
             self.y_min > other.y_max
         )
 
+    def contains_rect(self, other):
+        return (
+            self.x_min <= other.x_min and other.x_max <= self.x_max and
+            self.y_min <= other.y_min and other.y_max <= self.y_max
+        )
+
     def is_inside(self, point):
         if point is None:
             return False
@@ -25,12 +56,16 @@ class rect:
         print((self.x_min,self.y_min),(self.x_min,self.y_max),(self.x_max,self.y_max),(self.x_max,self.y_min))
 
 class kd_tree_node:
+    __slots__=('left_leaf','right_leaf','rect','point','depth','size')
+
     def __init__(self, depth, point: tuple[float, float], rect, left_leaf, right_leaf):
         self.left_leaf=left_leaf
         self.right_leaf=right_leaf
         self.rect=rect
         self.point=point
         self.depth=depth
+        # live points in this subtree, filled in by the builds and kept up to date by dynamic_kd_tree
+        self.size=0
         
 def partition(A,p,r,b):
     x=A[r][b]
@@ -57,7 +92,7 @@ def find_median(A,p,r,b):
     return quick_select(A,p,r,abs((r-p+1)//2)+p,b)
 
 def find_min_max(A: list[tuple[float, float]]):
-    x_max,x_min,y_max,y_min=0,float('inf'),0,float('inf')
+    x_max,x_min,y_max,y_min=float('-inf'),float('inf'),float('-inf'),float('inf')
     
     for element in A:
         x_max=max(x_max,element[0])
@@ -69,6 +104,10 @@ def find_min_max(A: list[tuple[float, float]]):
 
 
 def build_kd_tree(A: list[tuple[float, float]]) -> kd_tree_node:
+    # (N, 2) arrays go to the flat, array-backed build
+    if isinstance(A, np.ndarray):
+        return build_kd_tree_array(A)
+
     x_min,x_max,y_min,y_max=find_min_max(A)
     base_rect=rect(x_min,x_max,y_min,y_max)
     base_of_a_tree=kd_tree_node(0,None,base_rect,None,None)
@@ -78,7 +117,8 @@ def build_kd_tree(A: list[tuple[float, float]]) -> kd_tree_node:
 
         if p>r:
             return None
-        elif p==r:
+        tree_node.size=r-p+1
+        if p==r:
             tree_node.point=p
             b=tree_node.depth%2
             q=p
@@ -114,19 +154,953 @@ def build_kd_tree(A: list[tuple[float, float]]) -> kd_tree_node:
 
     return base_of_a_tree
 
-def points_inside_rect(rect_section: rect, kd_tree_base: kd_tree_node) -> list[tuple[float, float]]:
+def points_inside_rect(rect_section: rect, kd_tree_base: 'kd_tree_node | kd_tree_array', stats: QueryStats = None) -> list[tuple[float, float]]:
+    # stats collects the traversal counters of this query, see query_stats.QueryStats
+    counts=None if stats is None else [0,0,0,0]
+    if isinstance(kd_tree_base, kd_tree_array):
+        solution=_as_point_list(list(_iter_rect_blocks(rect_section,kd_tree_base,counts)))
+    else:
+        solution=_points_inside_rect_node(rect_section,kd_tree_base,counts)
+
+    if stats is not None:
+        stats.record(*counts,len(solution))
+    return solution
+
+
+def _points_inside_rect_node(rect_section: rect, kd_tree_base: kd_tree_node, counts: list[int] = None) -> list[tuple[float, float]]:
+    # counts, when given, collects nodes_visited, box_tests, points_tested and points_accepted
     start=kd_tree_base
     queue,solution=[],[]
     queue.append(start)
     while len(queue):
         tree_node=queue.pop()
+        if counts is not None:
+            counts[0]+=1
+            counts[1]+=1
+        # whole subtree lies in the section, take its points without testing them
+        if rect_section.contains_rect(tree_node.rect):
+            covered=subtree_points(tree_node)
+            if counts is not None:
+                counts[3]+=len(covered)
+            solution.extend(covered)
+            continue
+
+        if counts is not None and tree_node.point is not None:
+            counts[2]+=1
         if rect_section.is_inside(tree_node.point):
             solution.append(tree_node.point)
 
-        if tree_node.left_leaf != None and rect_section.crossing(tree_node.left_leaf.rect):
-            queue.append(tree_node.left_leaf)
+        for child in (tree_node.left_leaf,tree_node.right_leaf):
+            if child != None:
+                if counts is not None:
+                    counts[1]+=1
+                if rect_section.crossing(child.rect):
+                    queue.append(child)
+            
+    return solution
+
 
-        if tree_node.right_leaf != None and rect_section.crossing(tree_node.right_leaf.rect):
+def subtree_points(kd_tree_base: kd_tree_node) -> list[tuple[float, float]]:
+    queue,solution=[kd_tree_base],[]
+    while len(queue):
+        tree_node=queue.pop()
+        if tree_node.point is not None:
+            solution.append(tree_node.point)
+        if tree_node.left_leaf != None:
+            queue.append(tree_node.left_leaf)
+        if tree_node.right_leaf != None:
             queue.append(tree_node.right_leaf)
-            
     return solution
+
+
+# KD-tree supporting insert/delete/move on top of kd_tree_node objects.
+# Every rect only has to cover the points below its node, so an insert just grows
+# the rects along its path. Deleted points are tombstoned (point set to None, which
+# queries already skip) and balance is restored scapegoat style: an insert landing too
+# deep rebuilds the lowest ancestor with a child holding more than KD_BALANCE_ALPHA of
+# its live points, and the whole tree is rebuilt once tombstones reach half of the
+# live points. Queries take tree.root like any other kd_tree_node.
+class dynamic_kd_tree:
+    def __init__(self, A: list[tuple[float, float]] = ()):
+        self.root=None
+        self.live=0
+        self.tombstones=0
+        self._rebuild_root(list(A))
+
+    def __len__(self):
+        return self.live
+
+    def _rebuild_root(self, A):
+        self.root=_build_sized(A,0) if len(A) else None
+        self.live=len(A)
+        self.tombstones=0
+
+    def insert(self, point: tuple[float, float]):
+        x,y=point[0],point[1]
+        self.live+=1
+        if self.root is None:
+            self.root=kd_tree_node(0,point,rect(x,x,y,y),None,None)
+            self.root.size=1
+            return
+
+        path=[]
+        tree_node=self.root
+        while True:
+            r=tree_node.rect
+            r.x_min,r.x_max,r.y_min,r.y_max=min(r.x_min,x),max(r.x_max,x),min(r.y_min,y),max(r.y_max,y)
+            tree_node.size+=1
+            path.append(tree_node)
+
+            # empty slot (tombstone or empty leaf of a static build) takes the point
+            if tree_node.point is None:
+                tree_node.point=point
+                break
+
+            b=tree_node.depth%2
+            left=point[b]<tree_node.point[b]
+            child=tree_node.left_leaf if left else tree_node.right_leaf
+            if child is None:
+                child=kd_tree_node(tree_node.depth+1,point,rect(x,x,y,y),None,None)
+                child.size=1
+                if left:
+                    tree_node.left_leaf=child
+                else:
+                    tree_node.right_leaf=child
+                path.append(child)
+                break
+            tree_node=child
+
+        # scapegoat: once the new point lands deeper than an alpha balanced tree allows,
+        # rebuild the lowest ancestor that got out of balance
+        if len(path)>math.log(self.live,1/KD_BALANCE_ALPHA)+1:
+            for parent,child in zip(reversed(path[:-1]),reversed(path[1:])):
+                if child.size>KD_BALANCE_ALPHA*parent.size:
+                    _rebuild_subtree(parent)
+                    break
+
+    def delete(self, point: tuple[float, float]) -> bool:
+        if self.root is None or not _tombstone(self.root,point):
+            return False
+
+        self.live-=1
+        self.tombstones+=1
+        if self.tombstones*2>self.live:
+            self._rebuild_root(subtree_points(self.root))
+        return True
+
+    def move(self, old: tuple[float, float], new: tuple[float, float]) -> bool:
+        if not self.delete(old):
+            return False
+        self.insert(new)
+        return True
+
+    def points_inside_rect(self, rect_section: rect) -> list[tuple[float, float]]:
+        if self.root is None:
+            return []
+        return points_inside_rect(rect_section,self.root)
+
+
+def _build_sized(A: list[tuple[float, float]], depth: int) -> kd_tree_node:
+    x_min,x_max,y_min,y_max=find_min_max(A)
+    return _build_sorted(A,depth,rect(x_min,x_max,y_min,y_max))
+
+
+def _build_sorted(A: list[tuple[float, float]], depth: int, tree_rect: rect) -> kd_tree_node:
+    # same median split as build_kd_tree, but with list.sort instead of quick_select,
+    # which degrades on the nearly sorted points collected from a subtree. Sizes are filled in.
+    b=depth%2
+    A.sort(key=lambda point: point[b])
+    q=len(A)//2
+    tree_node=kd_tree_node(depth,A[q],tree_rect,None,None)
+    tree_node.size=len(A)
+
+    split=A[q][b]
+    if b:
+        left_rect=rect(tree_rect.x_min,tree_rect.x_max,tree_rect.y_min,split)
+        right_rect=rect(tree_rect.x_min,tree_rect.x_max,split,tree_rect.y_max)
+    else:
+        left_rect=rect(tree_rect.x_min,split,tree_rect.y_min,tree_rect.y_max)
+        right_rect=rect(split,tree_rect.x_max,tree_rect.y_min,tree_rect.y_max)
+    if q>0:
+        tree_node.left_leaf=_build_sorted(A[:q],depth+1,left_rect)
+    if q+1<len(A):
+        tree_node.right_leaf=_build_sorted(A[q+1:],depth+1,right_rect)
+    return tree_node
+
+
+def _rebuild_subtree(tree_node: kd_tree_node):
+    # rebuilt in place, so the parent keeps pointing at the same object
+    A=subtree_points(tree_node)
+    fresh=_build_sized(A,tree_node.depth)
+    tree_node.point,tree_node.rect,tree_node.size=fresh.point,fresh.rect,fresh.size
+    tree_node.left_leaf,tree_node.right_leaf=fresh.left_leaf,fresh.right_leaf
+
+
+def _tombstone(tree_node: kd_tree_node, point: tuple[float, float]) -> bool:
+    # only subtrees whose rect covers the point can hold it
+    if tree_node is None or not tree_node.rect.is_inside(point):
+        return False
+
+    p=tree_node.point
+    if p is not None and p[0]==point[0] and p[1]==point[1]:
+        tree_node.point=None
+    elif not (_tombstone(tree_node.left_leaf,point) or _tombstone(tree_node.right_leaf,point)):
+        return False
+
+    tree_node.size-=1
+    return True
+
+
+# Flat, implicit KD-tree. There is no node object: the node covering points[lo:hi]
+# keeps its median at mid=lo+(hi-lo)//2, its left subtree in points[lo:mid] and
+# its right subtree in points[mid+1:hi], so a whole tree is a handful of arrays.
+# split_axis/split_value are indexed by the median position of each node.
+# Ranges of at most leaf_size points are not split any further, they are leaf
+# buckets tested with one NumPy mask (or emitted whole when the query covers them).
+# With weights, weight_cumsum gives the sum over any range and weight_min/weight_max
+# keep each node's subtree minimum/maximum under its key (median, or lo for a leaf).
+class kd_tree_array:
+    def __init__(self, points: np.ndarray, index: np.ndarray, split_axis: np.ndarray, split_value: np.ndarray, rect, leaf_size=1,
+                 weights=None, weight_cumsum=None, weight_min=None, weight_max=None):
+        self.points=points
+        self.index=index
+        self.split_axis=split_axis
+        self.split_value=split_value
+        self.rect=rect
+        self.leaf_size=leaf_size
+        self.weights=weights
+        self.weight_cumsum=weight_cumsum
+        self.weight_min=weight_min
+        self.weight_max=weight_max
+
+    def __len__(self):
+        return len(self.points)
+
+
+def _partition_segments(A,index,lo,hi,b):
+    # moves the median along axis b of every points[lo[i]:hi[i]] to its mid=lo+(hi-lo)//2,
+    # smaller or equal coordinates before it and greater or equal ones after it, in O(n) per level.
+    # Median splits keep the segments of one depth within a point of each other's size, so
+    # the segments of each size are partitioned together as the rows of one matrix.
+    size=hi-lo
+    order=np.arange(len(A))
+    for s in np.unique(size).tolist():
+        rows=lo[size==s][:,None]+np.arange(s)
+        order[rows]=np.take_along_axis(rows,np.argpartition(A[rows,b],s//2,axis=1),axis=1)
+    A[:]=A[order]
+    index[:]=index[order]
+
+
+def _build_levels(A,index,split_axis,split_value,lo,hi,depth,leaf_size,max_segments=None):
+    # all nodes of one depth are split together, ranges of up to leaf_size points are leaves.
+    # Stops early once a depth has max_segments ranges left to split and returns them.
+    while True:
+        keep=hi-lo>leaf_size
+        lo,hi=lo[keep],hi[keep]
+        if not len(lo) or (max_segments is not None and len(lo)>=max_segments):
+            return lo,hi,depth
+
+        b=depth%2
+        _partition_segments(A,index,lo,hi,b)
+        mid=lo+(hi-lo)//2
+        split_axis[mid]=b
+        split_value[mid]=A[mid,b]
+
+        lo,hi=np.concatenate((lo,mid+1)),np.concatenate((mid,hi))
+        depth+=1
+
+
+def build_kd_tree_array(A: np.ndarray, leaf_size: int = 1, weights: np.ndarray = None, workers: int = 1) -> kd_tree_array:
+    # float64 (N, 2) input is permuted in place, anything else is copied first
+    A=np.asarray(A,dtype=np.float64)
+    leaf_size=max(1,leaf_size)
+    n=len(A)
+
+    if n:
+        (x_min,y_min),(x_max,y_max)=A.min(axis=0),A.max(axis=0)
+    else:
+        x_min,x_max,y_min,y_max=0.0,0.0,0.0,0.0
+    base_rect=rect(float(x_min),float(x_max),float(y_min),float(y_max))
+
+    if workers>1 and n>=KD_PARALLEL_MIN:
+        index,split_axis,split_value=_build_parallel(A,leaf_size,workers)
+    else:
+        index=np.arange(n)
+        split_axis=np.zeros(n,dtype=np.int8)
+        split_value=np.zeros(n)
+        _build_levels(A,index,split_axis,split_value,np.array([0]),np.array([n]),0,leaf_size)
+
+    tree=kd_tree_array(A,index,split_axis,split_value,base_rect,leaf_size)
+    if weights is not None:
+        _summarize(tree,np.asarray(weights,dtype=np.float64)[index])
+    return tree
+
+
+# views of the shared build arrays inside a pool worker, set up by _attach_shared
+_shared={}
+
+
+def _attach_shared(names,n,leaf_size):
+    blocks=[shared_memory.SharedMemory(name=name) for name in names]
+    _shared.update(blocks=blocks,n=n,leaf_size=leaf_size,arrays=_shared_views(blocks,n))
+
+
+def _shared_views(blocks,n):
+    # A, index, split_axis, split_value over the shared memory blocks
+    shapes=[((n,2),np.float64),((n,),np.int64),((n,),np.int8),((n,),np.float64)]
+    return [np.ndarray(shape,dtype=dtype,buffer=block.buf) for (shape,dtype),block in zip(shapes,blocks)]
+
+
+def _build_shared_subtree(task):
+    # builds the subtree over [lo, hi) in place. Positions inside the range are the same
+    # relative to its median as in the whole tree, so the serial level loop runs on the slices.
+    # With max_segments it stops once that many subtrees are left and returns them as tasks.
+    lo,hi,depth,max_segments=task
+    A,index,split_axis,split_value=_shared['arrays']
+    sub_lo,sub_hi,sub_depth=_build_levels(A[lo:hi],index[lo:hi],split_axis[lo:hi],split_value[lo:hi],
+                                          np.array([0]),np.array([hi-lo]),depth,_shared['leaf_size'],max_segments)
+    return [(lo+l,lo+h,sub_depth) for l,h in zip(sub_lo.tolist(),sub_hi.tolist())]
+
+
+def _build_parallel(A,leaf_size,workers):
+    # a process pool builds the tree directly in shared memory: the top nodes are split one
+    # per task until every worker has a subtree, then the subtrees are built whole. Every
+    # node goes through the same steps as in the serial build, so the result is identical.
+    n=len(A)
+    sizes=[A.nbytes,n*8,n,n*8]
+    blocks=[shared_memory.SharedMemory(create=True,size=max(1,size)) for size in sizes]
+    try:
+        return _build_parallel_shared(A,blocks,leaf_size,workers)
+    finally:
+        for block in blocks:
+            block.unlink()
+            block.close()
+
+
+def _build_parallel_shared(A,blocks,leaf_size,workers):
+    n=len(A)
+    shared_A,index,split_axis,split_value=_shared_views(blocks,n)
+    shared_A[:]=A
+    index[:]=np.arange(n)
+    split_axis[:]=0
+    split_value[:]=0.0
+
+    with ProcessPoolExecutor(workers,initializer=_attach_shared,
+                             initargs=([block.name for block in blocks],n,leaf_size)) as pool:
+        # each round splits every node in two, nodes of the same round run side by side
+        tasks=[(0,n,0)]
+        while tasks and len(tasks)<workers:
+            tasks=list(itertools.chain.from_iterable(pool.map(_build_shared_subtree,[task+(2,) for task in tasks])))
+        # largest subtrees first, so no worker is left with a big one at the end
+        tasks.sort(key=lambda task: task[0]-task[1])
+        list(pool.map(_build_shared_subtree,[task+(None,) for task in tasks]))
+
+    A[:]=shared_A
+    return index.copy(),split_axis.copy(),split_value.copy()
+
+
+def _node_ranges(tree: kd_tree_array):
+    # yields (lo, hi, key) arrays of all non-empty nodes, one depth at a time
+    leaf_size=tree.leaf_size
+    lo,hi=np.array([0]),np.array([len(tree)])
+    while True:
+        keep=hi>lo
+        lo,hi=lo[keep],hi[keep]
+        if not len(lo):
+            return
+        mid=lo+(hi-lo)//2
+        leaf=hi-lo<=leaf_size
+        yield lo,hi,np.where(leaf,lo,mid)
+        lo,hi,mid=lo[~leaf],hi[~leaf],mid[~leaf]
+        lo,hi=np.concatenate((lo,mid+1)),np.concatenate((mid,hi))
+
+
+def _summarize(tree: kd_tree_array, weights: np.ndarray):
+    n=len(weights)
+    tree.weights=weights
+    tree.weight_cumsum=np.concatenate(([0.0],np.cumsum(weights)))
+    tree.weight_min=np.zeros(n)
+    tree.weight_max=np.zeros(n)
+
+    # reduceat over [lo0, hi0, lo1, hi1, ...] of position-sorted ranges, every other result is a node
+    padded=np.append(weights,0.0)
+    for lo,hi,key in _node_ranges(tree):
+        order=np.argsort(lo)
+        bounds=np.column_stack((lo[order],hi[order])).ravel()
+        tree.weight_min[key[order]]=np.minimum.reduceat(padded,bounds)[::2]
+        tree.weight_max[key[order]]=np.maximum.reduceat(padded,bounds)[::2]
+
+
+def _child_rects(tree: kd_tree_array, mid, x_min, x_max, y_min, y_max):
+    s=float(tree.split_value[mid])
+    if tree.split_axis[mid]:
+        return (x_min,x_max,y_min,s),(x_min,x_max,s,y_max)
+    return (x_min,s,y_min,y_max),(s,x_max,y_min,y_max)
+
+
+def _crossing(rect_section: rect, x_min, x_max, y_min, y_max):
+    return not (
+        rect_section.x_max < x_min or
+        rect_section.x_min > x_max or
+        rect_section.y_max < y_min or
+        rect_section.y_min > y_max
+    )
+
+
+def _covers(rect_section: rect, x_min, x_max, y_min, y_max):
+    return (
+        rect_section.x_min <= x_min and x_max <= rect_section.x_max and
+        rect_section.y_min <= y_min and y_max <= rect_section.y_max
+    )
+
+
+def _mask_inside(rect_section: rect, block: np.ndarray) -> np.ndarray:
+    return (
+        (rect_section.x_min <= block[:,0]) & (block[:,0] <= rect_section.x_max) &
+        (rect_section.y_min <= block[:,1]) & (block[:,1] <= rect_section.y_max)
+    )
+
+
+def _as_point_list(blocks: list[np.ndarray]) -> list[tuple[float, float]]:
+    if not blocks:
+        return []
+    return list(map(tuple,np.concatenate(blocks).tolist()))
+
+
+def points_inside_rect_np(rect_section: rect, tree: kd_tree_array) -> np.ndarray:
+    # same as points_inside_rect, but the matches stay one (K, 2) array
+    blocks=_rect_blocks(rect_section,tree)
+    if not blocks:
+        return np.empty((0,2))
+    return np.concatenate(blocks)
+
+
+def iter_range(rect_section: rect, kd_tree_base: 'kd_tree_node | kd_tree_array', limit: int = None):
+    # yields the points inside rect_section one by one, nothing is collected on the way,
+    # so a consumer can stream them out or stop after limit points
+    if isinstance(kd_tree_base, kd_tree_array):
+        points=(point for block in _iter_rect_blocks(rect_section,kd_tree_base) for point in map(tuple,block.tolist()))
+    else:
+        points=_iter_node_range(rect_section,kd_tree_base)
+    return itertools.islice(points,limit)
+
+
+def _iter_node_range(rect_section: rect, kd_tree_base: kd_tree_node):
+    # explicit stack of (node, covered), below a covered node nothing is tested any more
+    stack=[(kd_tree_base,False)]
+    while len(stack):
+        tree_node,covered=stack.pop()
+        covered=covered or rect_section.contains_rect(tree_node.rect)
+        if covered:
+            if tree_node.point is not None:
+                yield tree_node.point
+        elif rect_section.is_inside(tree_node.point):
+            yield tree_node.point
+
+        for child in (tree_node.right_leaf,tree_node.left_leaf):
+            if child is not None and (covered or rect_section.crossing(child.rect)):
+                stack.append((child,covered))
+
+
+def iter_range_chunks(rect_section: rect, kd_tree_base: 'kd_tree_node | kd_tree_array', chunk_size: int = KD_CHUNK_SIZE,
+                      limit: int = None):
+    # same points as iter_range, as (chunk_size, 2) arrays (the last one shorter). At most
+    # about one chunk is held at a time, whatever the number of matches.
+    if isinstance(kd_tree_base, kd_tree_array):
+        blocks=_iter_rect_blocks(rect_section,kd_tree_base)
+    else:
+        points=_iter_node_range(rect_section,kd_tree_base)
+        batches=iter(lambda: [(p[0],p[1]) for p in itertools.islice(points,chunk_size)],[])
+        blocks=(np.array(batch,dtype=np.float64) for batch in batches)
+    return chunked(blocks,chunk_size,limit)
+
+
+def _rect_blocks(rect_section: rect, tree: kd_tree_array) -> list[np.ndarray]:
+    return list(_iter_rect_blocks(rect_section,tree))
+
+
+def _iter_rect_blocks(rect_section: rect, tree: kd_tree_array, counts: list[int] = None):
+    # yields blocks of matching points: slices of covered subtrees, filtered leaf buckets and medians
+    # counts, when given, collects nodes_visited, box_tests, points_tested and points_accepted
+    A=tree.points
+    stack=[(0,len(A),tree.rect.x_min,tree.rect.x_max,tree.rect.y_min,tree.rect.y_max)]
+    while len(stack):
+        lo,hi,x_min,x_max,y_min,y_max=stack.pop()
+        if hi<=lo:
+            continue
+
+        if counts is not None:
+            counts[0]+=1
+            counts[1]+=1
+        # every subtree owns the contiguous range points[lo:hi], a covered node is one slice
+        if _covers(rect_section,x_min,x_max,y_min,y_max):
+            if counts is not None:
+                counts[3]+=hi-lo
+            yield A[lo:hi]
+            continue
+
+        # leaf bucket only partly covered, filter it with a single mask
+        if hi-lo<=tree.leaf_size:
+            if counts is not None:
+                counts[2]+=hi-lo
+            block=A[lo:hi]
+            yield block[_mask_inside(rect_section,block)]
+            continue
+
+        mid=lo+(hi-lo)//2
+        if counts is not None:
+            counts[2]+=1
+        if rect_section.is_inside((A[mid,0],A[mid,1])):
+            yield A[mid:mid+1]
+
+        left_rect,right_rect=_child_rects(tree,mid,x_min,x_max,y_min,y_max)
+        for child in ((lo,mid)+left_rect,(mid+1,hi)+right_rect):
+            if child[0]<child[1]:
+                if counts is not None:
+                    counts[1]+=1
+                if _crossing(rect_section,*child[2:]):
+                    stack.append(child)
+
+
+
+def query_polygon(polygon, kd_tree_base: 'kd_tree_node | kd_tree_array') -> list[tuple[float, float]]:
+    # points inside a polygon (vertices, a visualizer Polygon or a prepared PolygonIndex).
+    # Subtrees outside the polygon are skipped, subtrees inside it are taken whole, and only
+    # points of boundary nodes go through one vectorized point-in-polygon test at the end.
+    index=polygon if isinstance(polygon, PolygonIndex) else PolygonIndex(polygon)
+    if isinstance(kd_tree_base, kd_tree_array):
+        return _query_polygon_array(index,kd_tree_base)
+
+    found,candidates=[],[]
+    # every node carries the edges touching its parent, the only ones that can touch it
+    stack=[(kd_tree_base,None)]
+    while len(stack):
+        tree_node,edges=stack.pop()
+        r=tree_node.rect
+        where,edges=index.classify(r.x_min,r.x_max,r.y_min,r.y_max,edges)
+        if where==OUTSIDE:
+            continue
+        if where==INSIDE:
+            found.extend(subtree_points(tree_node))
+            continue
+
+        if tree_node.point is not None:
+            candidates.append(tree_node.point)
+        for child in (tree_node.left_leaf,tree_node.right_leaf):
+            if child is not None:
+                stack.append((child,edges))
+
+    if candidates:
+        mask=index.contains(np.array([(p[0],p[1]) for p in candidates]))
+        found.extend(itertools.compress(candidates,mask.tolist()))
+    return found
+
+
+def _query_polygon_array(index: PolygonIndex, tree: kd_tree_array) -> list[tuple[float, float]]:
+    A=tree.points
+    blocks,candidates=[],[]
+    stack=[(0,len(A),tree.rect.x_min,tree.rect.x_max,tree.rect.y_min,tree.rect.y_max,None)]
+    while len(stack):
+        lo,hi,x_min,x_max,y_min,y_max,edges=stack.pop()
+        if hi<=lo:
+            continue
+
+        where,edges=index.classify(x_min,x_max,y_min,y_max,edges)
+        if where==OUTSIDE:
+            continue
+        if where==INSIDE:
+            blocks.append(A[lo:hi])
+            continue
+
+        if hi-lo<=tree.leaf_size:
+            candidates.append(A[lo:hi])
+            continue
+
+        mid=lo+(hi-lo)//2
+        candidates.append(A[mid:mid+1])
+        left_rect,right_rect=_child_rects(tree,mid,x_min,x_max,y_min,y_max)
+        stack.append((lo,mid)+left_rect+(edges,))
+        stack.append((mid+1,hi)+right_rect+(edges,))
+
+    if candidates:
+        candidates=np.concatenate(candidates)
+        blocks.append(candidates[index.contains(candidates)])
+    return _as_point_list(blocks)
+
+
+def query_many(rects: np.ndarray, tree: kd_tree_array) -> tuple[np.ndarray, np.ndarray]:
+    # Answers M rectangles, given as an (M, 4) array of x_min, x_max, y_min, y_max, with one
+    # traversal of the array tree. Every node carries the queries still crossing it, so each
+    # containment test runs over all of them at once.
+    # Returns (offsets, indices): matches of rect i are tree.points[indices[offsets[i]:offsets[i+1]]]
+    R=np.asarray(rects,dtype=np.float64).reshape(-1,4)
+    A=tree.points
+    query_ids,found=[],[]
+
+    def inside(active,block):
+        r=R[active]
+        return (
+            (r[:,0,None] <= block[None,:,0]) & (block[None,:,0] <= r[:,1,None]) &
+            (r[:,2,None] <= block[None,:,1]) & (block[None,:,1] <= r[:,3,None])
+        )
+
+    def crossing(active,x_min,x_max,y_min,y_max):
+        r=R[active]
+        return active[~((r[:,1] < x_min) | (r[:,0] > x_max) | (r[:,3] < y_min) | (r[:,2] > y_max))]
+
+    root=tree.rect
+    stack=[(0,len(A),root.x_min,root.x_max,root.y_min,root.y_max,crossing(np.arange(len(R)),root.x_min,root.x_max,root.y_min,root.y_max))]
+    while len(stack):
+        lo,hi,x_min,x_max,y_min,y_max,active=stack.pop()
+        if hi<=lo or not len(active):
+            continue
+
+        # queries covering the whole node take its range and stop here
+        r=R[active]
+        covered=(r[:,0] <= x_min) & (x_max <= r[:,1]) & (r[:,2] <= y_min) & (y_max <= r[:,3])
+        if covered.any():
+            query_ids.append(np.repeat(active[covered],hi-lo))
+            found.append(np.tile(np.arange(lo,hi),covered.sum()))
+            active=active[~covered]
+            if not len(active):
+                continue
+
+        if hi-lo<=tree.leaf_size:
+            q,p=np.nonzero(inside(active,A[lo:hi]))
+            query_ids.append(active[q])
+            found.append(p+lo)
+            continue
+
+        mid=lo+(hi-lo)//2
+        q=active[inside(active,A[mid:mid+1])[:,0]]
+        query_ids.append(q)
+        found.append(np.full(len(q),mid))
+
+        left_rect,right_rect=_child_rects(tree,mid,x_min,x_max,y_min,y_max)
+        if lo<mid:
+            stack.append((lo,mid)+left_rect+(crossing(active,*left_rect),))
+        if mid+1<hi:
+            stack.append((mid+1,hi)+right_rect+(crossing(active,*right_rect),))
+
+    return csr(query_ids,found,len(R))
+
+
+def _range_summaries(rect_section: rect, tree: kd_tree_array, with_weights: bool):
+    # (count, sum, min, max) of the points inside rect_section. Covered nodes add
+    # their precomputed summary, so the cost does not grow with the number of matches.
+    A,w=tree.points,tree.weights
+    count,total,low,high=0,0.0,float('inf'),float('-inf')
+    stack=[(0,len(A),tree.rect.x_min,tree.rect.x_max,tree.rect.y_min,tree.rect.y_max)]
+    while len(stack):
+        lo,hi,x_min,x_max,y_min,y_max=stack.pop()
+        if hi<=lo:
+            continue
+
+        mid=lo+(hi-lo)//2
+        leaf=hi-lo<=tree.leaf_size
+        if _covers(rect_section,x_min,x_max,y_min,y_max):
+            count+=hi-lo
+            if with_weights:
+                key=lo if leaf else mid
+                total+=tree.weight_cumsum[hi]-tree.weight_cumsum[lo]
+                low,high=min(low,tree.weight_min[key]),max(high,tree.weight_max[key])
+            continue
+
+        if leaf:
+            mask=_mask_inside(rect_section,A[lo:hi])
+            matched=int(mask.sum())
+            count+=matched
+            if with_weights and matched:
+                selected=w[lo:hi][mask]
+                total+=selected.sum()
+                low,high=min(low,selected.min()),max(high,selected.max())
+            continue
+
+        if rect_section.is_inside((A[mid,0],A[mid,1])):
+            count+=1
+            if with_weights:
+                total+=w[mid]
+                low,high=min(low,w[mid]),max(high,w[mid])
+
+        left_rect,right_rect=_child_rects(tree,mid,x_min,x_max,y_min,y_max)
+        if lo<mid and _crossing(rect_section,*left_rect):
+            stack.append((lo,mid)+left_rect)
+        if mid+1<hi and _crossing(rect_section,*right_rect):
+            stack.append((mid+1,hi)+right_rect)
+
+    return count,float(total),float(low),float(high)
+
+
+def count_range(rect_section: rect, tree: 'kd_tree_node | kd_tree_array') -> int:
+    if isinstance(tree, kd_tree_array):
+        return _range_summaries(rect_section,tree,False)[0]
+
+    # subtrees inside rect_section count by their size, only nodes crossing its edge test their point
+    queue,count=[tree],0
+    while len(queue):
+        tree_node=queue.pop()
+        if rect_section.contains_rect(tree_node.rect):
+            count+=tree_node.size
+            continue
+
+        if tree_node.point is not None and rect_section.is_inside(tree_node.point):
+            count+=1
+
+        for child in (tree_node.left_leaf,tree_node.right_leaf):
+            if child != None and rect_section.crossing(child.rect):
+                queue.append(child)
+
+    return count
+
+
+def aggregate_range(rect_section: rect, tree: 'kd_tree_node | kd_tree_array') -> dict[str, float]:
+    # count, sum, mean, min and max of the weights inside rect_section,
+    # a tree built without weights (kd_tree_node trees never have any) counts every point with weight 1.0
+    if not isinstance(tree, kd_tree_array) or tree.weights is None:
+        count=count_range(rect_section,tree)
+        total,low,high=float(count),1.0,1.0
+    else:
+        count,total,low,high=_range_summaries(rect_section,tree,True)
+
+    if not count:
+        return {'count': 0, 'sum': 0.0, 'mean': float('nan'), 'min': float('nan'), 'max': float('nan')}
+    return {'count': count, 'sum': total, 'mean': total/count, 'min': low, 'max': high}
+
+
+def _rect_distance(point, x_min, x_max, y_min, y_max):
+    # squared distance from point to the closest point of the rect, 0 inside it
+    dx=max(x_min-point[0],0.0,point[0]-x_max)
+    dy=max(y_min-point[1],0.0,point[1]-y_max)
+    return dx*dx+dy*dy
+
+
+def knn(point: tuple[float, float], k: int, kd_tree_base: 'kd_tree_node | kd_tree_array') -> list[tuple[float, float]]:
+    # k nearest points, nearest first. Nodes are taken best-first by the distance to their
+    # rect and the search stops once no rect is closer than the current k-th neighbour.
+    if k<=0:
+        return []
+
+    # max-heap of the best k (negated distances), counter breaks ties between equal keys
+    best=[]
+    counter=itertools.count()
+
+    def offer(distance,candidate):
+        if len(best)<k:
+            heapq.heappush(best,(-distance,next(counter),candidate))
+        elif distance<-best[0][0]:
+            heapq.heapreplace(best,(-distance,next(counter),candidate))
+
+    def worth(distance):
+        return len(best)<k or distance<=-best[0][0]
+
+    # heap entries hold kd_tree_node objects or (lo, hi, rect) ranges of the array tree
+    base=kd_tree_base.rect
+    root=kd_tree_base
+    if isinstance(kd_tree_base, kd_tree_array):
+        A=kd_tree_base.points
+        root=(0,len(A),base.x_min,base.x_max,base.y_min,base.y_max)
+    nodes=[(_rect_distance(point,base.x_min,base.x_max,base.y_min,base.y_max),next(counter),root)]
+
+    while len(nodes):
+        node_distance,_,node=heapq.heappop(nodes)
+        if not worth(node_distance):
+            break
+
+        if isinstance(node, kd_tree_node):
+            if node.point is not None:
+                offer((node.point[0]-point[0])**2+(node.point[1]-point[1])**2,node.point)
+            for child in (node.left_leaf,node.right_leaf):
+                if child is not None:
+                    child_distance=_rect_distance(point,child.rect.x_min,child.rect.x_max,child.rect.y_min,child.rect.y_max)
+                    if worth(child_distance):
+                        heapq.heappush(nodes,(child_distance,next(counter),child))
+            continue
+
+        lo,hi,x_min,x_max,y_min,y_max=node
+        if hi<=lo:
+            continue
+
+        if hi-lo<=kd_tree_base.leaf_size:
+            block=A[lo:hi]
+            distances=(block[:,0]-point[0])**2+(block[:,1]-point[1])**2
+            for i in np.argsort(distances).tolist():
+                if not worth(distances[i]):
+                    break
+                offer(float(distances[i]),tuple(block[i].tolist()))
+            continue
+
+        mid=lo+(hi-lo)//2
+        offer(float((A[mid,0]-point[0])**2+(A[mid,1]-point[1])**2),tuple(A[mid].tolist()))
+        left_rect,right_rect=_child_rects(kd_tree_base,mid,x_min,x_max,y_min,y_max)
+        for child_lo,child_hi,child_rect in ((lo,mid,left_rect),(mid+1,hi,right_rect)):
+            child_distance=_rect_distance(point,*child_rect)
+            if child_lo<child_hi and worth(child_distance):
+                heapq.heappush(nodes,(child_distance,next(counter),(child_lo,child_hi)+child_rect))
+
+    return [candidate for _,_,candidate in sorted(best,key=lambda item: (-item[0],item[1]))]
+
+
+def knn_many(points: np.ndarray, k: int, kd_tree_base: 'kd_tree_node | kd_tree_array') -> np.ndarray:
+    # knn for every row of an (M, 2) array, (M, k, 2) result padded with NaN past the tree size
+    points=np.asarray(points,dtype=np.float64).reshape(-1,2)
+    out=np.full((len(points),k,2),np.nan)
+    for i,point in enumerate(points.tolist()):
+        neighbours=knn(point,k,kd_tree_base)
+        if neighbours:
+            out[i,:len(neighbours)]=neighbours
+
+    return out
+
+
+def _rect_max_distance(point, x_min, x_max, y_min, y_max):
+    # squared distance from point to the farthest corner of the rect
+    dx=max(point[0]-x_min,x_max-point[0])
+    dy=max(point[1]-y_min,y_max-point[1])
+    return dx*dx+dy*dy
+
+
+def query_radius(center: tuple[float, float], radius: float, kd_tree_base: 'kd_tree_node | kd_tree_array') -> list[tuple[float, float]]:
+    # all points within distance radius of center. Nodes the circle misses are pruned,
+    # nodes whose four corners are in the circle are taken whole.
+    r2=radius*radius
+
+    if not isinstance(kd_tree_base, kd_tree_array):
+        queue,solution=[kd_tree_base],[]
+        while len(queue):
+            tree_node=queue.pop()
+            r=tree_node.rect
+            if _rect_distance(center,r.x_min,r.x_max,r.y_min,r.y_max)>r2:
+                continue
+            if _rect_max_distance(center,r.x_min,r.x_max,r.y_min,r.y_max)<=r2:
+                solution.extend(subtree_points(tree_node))
+                continue
+            point=tree_node.point
+            if point is not None and (point[0]-center[0])**2+(point[1]-center[1])**2<=r2:
+                solution.append(point)
+            for child in (tree_node.left_leaf,tree_node.right_leaf):
+                if child is not None:
+                    queue.append(child)
+        return solution
+
+    A=kd_tree_base.points
+    blocks=[]
+    base=kd_tree_base.rect
+    stack=[(0,len(A),base.x_min,base.x_max,base.y_min,base.y_max)]
+    while len(stack):
+        lo,hi,x_min,x_max,y_min,y_max=stack.pop()
+        if hi<=lo or _rect_distance(center,x_min,x_max,y_min,y_max)>r2:
+            continue
+
+        if _rect_max_distance(center,x_min,x_max,y_min,y_max)<=r2:
+            blocks.append(A[lo:hi])
+            continue
+
+        if hi-lo<=kd_tree_base.leaf_size:
+            block=A[lo:hi]
+            blocks.append(block[(block[:,0]-center[0])**2+(block[:,1]-center[1])**2<=r2])
+            continue
+
+        mid=lo+(hi-lo)//2
+        if (A[mid,0]-center[0])**2+(A[mid,1]-center[1])**2<=r2:
+            blocks.append(A[mid:mid+1])
+        left_rect,right_rect=_child_rects(kd_tree_base,mid,x_min,x_max,y_min,y_max)
+        stack.append((lo,mid)+left_rect)
+        stack.append((mid+1,hi)+right_rect)
+
+    return _as_point_list(blocks)
+
+
+def query_radius_many(centers: np.ndarray, radii, tree: kd_tree_array) -> tuple[np.ndarray, np.ndarray]:
+    # radius version of query_many: (M, 2) centers, one radius or an (M,) array of them.
+    # Returns (offsets, indices): matches of circle i are tree.points[indices[offsets[i]:offsets[i+1]]]
+    C=np.asarray(centers,dtype=np.float64).reshape(-1,2)
+    r2=np.broadcast_to(np.asarray(radii,dtype=np.float64),(len(C),))**2
+    A=tree.points
+    query_ids,found=[],[]
+
+    root=tree.rect
+    stack=[(0,len(A),root.x_min,root.x_max,root.y_min,root.y_max,np.arange(len(C)))]
+    while len(stack):
+        lo,hi,x_min,x_max,y_min,y_max,active=stack.pop()
+        if hi<=lo or not len(active):
+            continue
+
+        # drop circles that don't reach the node, circles holding all four corners take its range
+        c=C[active]
+        dx=np.maximum(np.maximum(x_min-c[:,0],c[:,0]-x_max),0)
+        dy=np.maximum(np.maximum(y_min-c[:,1],c[:,1]-y_max),0)
+        near=dx*dx+dy*dy<=r2[active]
+        active,c=active[near],c[near]
+        if not len(active):
+            continue
+        dx=np.maximum(c[:,0]-x_min,x_max-c[:,0])
+        dy=np.maximum(c[:,1]-y_min,y_max-c[:,1])
+        covered=dx*dx+dy*dy<=r2[active]
+        if covered.any():
+            query_ids.append(np.repeat(active[covered],hi-lo))
+            found.append(np.tile(np.arange(lo,hi),covered.sum()))
+            active,c=active[~covered],c[~covered]
+            if not len(active):
+                continue
+
+        leaf=hi-lo<=tree.leaf_size
+        mid=lo+(hi-lo)//2
+        block_lo,block_hi=(lo,hi) if leaf else (mid,mid+1)
+        block=A[block_lo:block_hi]
+        distances=(c[:,0,None]-block[None,:,0])**2+(c[:,1,None]-block[None,:,1])**2
+        q,p=np.nonzero(distances<=r2[active,None])
+        query_ids.append(active[q])
+        found.append(p+block_lo)
+        if leaf:
+            continue
+
+        left_rect,right_rect=_child_rects(tree,mid,x_min,x_max,y_min,y_max)
+        stack.append((lo,mid)+left_rect+(active,))
+        stack.append((mid+1,hi)+right_rect+(active,))
+
+    return csr(query_ids,found,len(C))
+
+
+def save_kd_tree(tree: kd_tree_array, path: str):
+    # split values, point order and coordinates go to disk as they are, load_kd_tree maps them back
+    arrays={'points':tree.points,'index':tree.index,'split_axis':tree.split_axis,'split_value':tree.split_value}
+    if tree.weights is not None:
+        arrays.update(weights=tree.weights,weight_cumsum=tree.weight_cumsum,weight_min=tree.weight_min,weight_max=tree.weight_max)
+    r=tree.rect
+    meta={'rect':[float(r.x_min),float(r.x_max),float(r.y_min),float(r.y_max)],'leaf_size':int(tree.leaf_size)}
+    save_index(path,'kd_tree_array',meta,arrays)
+
+
+def load_kd_tree(path: str, verify: bool = False) -> kd_tree_array:
+    # arrays stay memory-mapped and read-only, every query function works on them unchanged
+    meta,arrays=load_index(path,'kd_tree_array',verify)
+    return kd_tree_array(rect=rect(*meta['rect']),leaf_size=meta['leaf_size'],**arrays)
+
+
+def kd_tree_shape(kd_tree_base: 'kd_tree_node | kd_tree_array') -> dict:
+    # depth histogram, leaf fill factor and empty leaves, see query_stats.shape_summary
+    # kd_tree_node leaves hold one point (none once tombstoned), array leaves up to leaf_size
+    if isinstance(kd_tree_base, kd_tree_array):
+        tree=kd_tree_base
+        def nodes():
+            stack=[(0,len(tree),0)]
+            while len(stack):
+                lo,hi,depth=stack.pop()
+                if hi<=lo:
+                    continue
+                if hi-lo<=tree.leaf_size:
+                    yield depth,True,hi-lo
+                    continue
+                mid=lo+(hi-lo)//2
+                yield depth,False,1
+                stack.extend(((lo,mid,depth+1),(mid+1,hi,depth+1)))
+        return shape_summary(nodes(),tree.leaf_size)
+
+    def nodes():
+        stack=[(kd_tree_base,0)]
+        while len(stack):
+            tree_node,depth=stack.pop()
+            children=[child for child in (tree_node.left_leaf,tree_node.right_leaf) if child != None]
+            yield depth,not children,int(tree_node.point is not None)
+            stack.extend((child,depth+1) for child in children)
+    return shape_summary(nodes(),1)
@@ -0,0 +1,160 @@
+import numpy as np
+
+from persist import load_index, save_index
+from quadtree import AABB, QT_MAX_DEPTH, QT_NODE_CAPACITY, morton_codes
+
+
+def _inside(points: np.ndarray, box: AABB) -> np.ndarray:
+    # vectorized AABB.contains_point
+    return ((box.x_min <= points[:, 0]) & (points[:, 0] <= box.x_max) &
+            (box.y_min <= points[:, 1]) & (points[:, 1] <= box.y_max))
+
+
+# Linear (pointerless) quad tree
+# There are no node objects: points are sorted by their Z-order key, so every quad of the
+# tree owns one contiguous run of keys and is found with two binary searches. A quad holding
+# at most capacity points plays the role of a leaf. Memory is 8 bytes of key plus 16 bytes
+# of coordinates per point.
+class LinearQuadTree:
+    def __init__(self, boundary: AABB, codes: np.ndarray, points: np.ndarray,
+                 capacity: int = QT_NODE_CAPACITY, depth: int = QT_MAX_DEPTH):
+        """
+        Wrap already sorted keys and their points, see BuildLinearQuadTree.
+
+        :param codes: (N,) sorted uint64 Z-order keys, computed with morton_codes.
+        :param points: (N, 2) points in key order.
+        """
+        self.boundary = boundary
+        self.codes = codes
+        self.points = points
+        self.capacity = capacity
+        self.depth = depth
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Bytes held by the index arrays
+        """
+        return self.codes.nbytes + self.points.nbytes
+
+    def key_intervals(self, box: AABB) -> tuple[list[tuple[int, int]], list[tuple[int, int]]]:
+        """
+        Decompose a box into runs of the sorted key array.
+
+        :param box: The range to decompose.
+        :return: (inside, partial) lists of (lo, hi) index runs. Every point of an inside run
+                 matches, points of partial runs still have to be checked against the box.
+        """
+        inside, partial = [], []
+        box_x_min, box_x_max = box.x_min, box.x_max
+        box_y_min, box_y_max = box.y_min, box.y_max
+
+        # (key prefix, level, quad center, quad half size, quad edges), same arithmetic as
+        # AABB.quadrants: a child's inner edges are its parent's center, its outer edges its parent's edges
+        b = self.boundary
+        stack = [(0, 0, b.center_x, b.center_y, b.half_width, b.half_height, b.x_min, b.x_max, b.y_min, b.y_max)]
+        while stack:
+            prefix, level, center_x, center_y, half_width, half_height, x_min, x_max, y_min, y_max = stack.pop()
+            if x_max < box_x_min or x_min > box_x_max or y_max < box_y_min or y_min > box_y_max:
+                continue
+
+            # keys of this quad are [prefix << shift, (prefix + 1) << shift), the upper bound
+            # of the root doesn't fit in uint64 when depth is 32
+            shift = 2 * (self.depth - level)
+            lo = int(np.searchsorted(self.codes, np.uint64(prefix << shift)))
+            upper = (prefix + 1) << shift
+            hi = len(self.codes) if upper >> 64 else int(np.searchsorted(self.codes, np.uint64(upper)))
+            if lo == hi:
+                continue
+
+            if box_x_min <= x_min and x_max <= box_x_max and box_y_min <= y_min and y_max <= box_y_max:
+                # merge with the previous run when the key ranges touch
+                if inside and inside[-1][1] == lo:
+                    inside[-1] = (inside[-1][0], hi)
+                else:
+                    inside.append((lo, hi))
+                continue
+
+            if hi - lo <= self.capacity or level == self.depth:
+                partial.append((lo, hi))
+                continue
+
+            # children pushed in reverse, so runs come out in key order
+            q_width, q_height = half_width / 2, half_height / 2
+            for digit in (3, 2, 1, 0):
+                child_x = center_x + q_width if digit & 1 else center_x - q_width
+                child_y = center_y + q_height if digit & 2 else center_y - q_height
+                child_x_edges = (center_x, x_max) if digit & 1 else (x_min, center_x)
+                child_y_edges = (center_y, y_max) if digit & 2 else (y_min, center_y)
+                stack.append((prefix * 4 + digit, level + 1, child_x, child_y, q_width, q_height) +
+                             child_x_edges + child_y_edges)
+
+        return inside, partial
+
+    def query_range_np(self, box: AABB) -> np.ndarray:
+        """
+        Find all points that appear within a box, as one (K, 2) array
+        """
+        inside, partial = self.key_intervals(box)
+        blocks = [self.points[lo:hi] for lo, hi in inside]
+        for lo, hi in partial:
+            block = self.points[lo:hi]
+            blocks.append(block[_inside(block, box)])
+
+        if not blocks:
+            return np.empty((0, 2))
+
+        return np.concatenate(blocks)
+
+    def query_range(self, box: AABB) -> list[tuple[float, float]]:
+        """
+        Find all points that appear within a box
+        """
+        return list(map(tuple, self.query_range_np(box).tolist()))
+
+    def count_range(self, box: AABB) -> int:
+        """
+        Count points that appear within a box, without collecting them
+        """
+        inside, partial = self.key_intervals(box)
+        count = sum(hi - lo for lo, hi in inside)
+        for lo, hi in partial:
+            block = self.points[lo:hi]
+            count += int(_inside(block, box).sum())
+
+        return count
+
+    def save(self, path: str) -> None:
+        """
+        Write the keys and points to disk, reopen them with load
+        """
+        b = self.boundary
+        meta = {'boundary': [float(b.center_x), float(b.center_y), float(b.half_width), float(b.half_height)],
+                'capacity': self.capacity, 'depth': self.depth}
+        save_index(path, 'linear_quadtree', meta, {'codes': self.codes, 'points': self.points})
+
+    @staticmethod
+    def load(path: str, verify: bool = False) -> 'LinearQuadTree':
+        """
+        Memory-map an index written by save, the arrays are not read until queried.
+
+        :param verify: Check the checksums of both arrays before returning.
+        """
+        meta, arrays = load_index(path, 'linear_quadtree', verify)
+        center_x, center_y, half_width, half_height = meta['boundary']
+        return LinearQuadTree(AABB((center_x, center_y), half_width, half_height), arrays['codes'], arrays['points'],
+                              meta['capacity'], meta['depth'])
+
+def BuildLinearQuadTree(boundary: AABB, node_capacity: int, points: np.ndarray,
+                        max_depth: int = QT_MAX_DEPTH) -> LinearQuadTree:
+    points = np.asarray(points, dtype=np.float64)
+    points = points[:, :2] if len(points) else np.empty((0, 2))
+    points = points[_inside(points, boundary)]
+
+    codes = morton_codes(points, boundary, max_depth)
+    order = np.argsort(codes, kind='stable')
+
+    return LinearQuadTree(boundary, codes[order], np.ascontiguousarray(points[order]), node_capacity, max_depth)
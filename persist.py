@@ -0,0 +1,97 @@
+import json
+import struct
+import zlib
+
+import numpy as np
+
+# On-disk layout shared by all indexes:
+#   magic (8 bytes) | format version (u32) | header length (u32) | header crc32 (u32) | padding (u32)
+#   JSON header: index kind, its scalar settings and for every array its dtype, shape,
+#                byte offset and crc32
+#   array data, every array starting on an ALIGNMENT boundary so it can be viewed in place
+MAGIC = b"QTKDIDX\0"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+_PREFIX = struct.Struct("<8sIII4x")
+
+
+class IndexFormatError(ValueError):
+    """
+    Raised when a file is not an index, has an unsupported version or fails a checksum
+    """
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def save_index(path: str, kind: str, meta: dict, arrays: dict[str, np.ndarray]) -> None:
+    """
+    Write named arrays and scalar settings of an index to one file.
+
+    :param kind: Name of the index type, checked again by load_index.
+    :param meta: JSON serializable settings, e.g. capacity or leaf size.
+    :param arrays: Arrays to store, written C-contiguous.
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+
+    # offsets depend on the header length, which depends on the offsets: lay out again until
+    # the header fits in front of the first array. Offsets only grow, so this settles.
+    checksums = {name: zlib.crc32(array.data) for name, array in arrays.items()}
+    entries = {}
+    header = b""
+    start = None
+    while start != _aligned(_PREFIX.size + len(header)):
+        start = offset = _aligned(_PREFIX.size + len(header))
+        for name, array in arrays.items():
+            entries[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset,
+                             "crc32": checksums[name]}
+            offset = _aligned(offset + array.nbytes)
+        header = json.dumps({"kind": kind, "meta": meta, "arrays": entries}).encode()
+
+    with open(path, "wb") as file:
+        file.write(_PREFIX.pack(MAGIC, FORMAT_VERSION, len(header), zlib.crc32(header)))
+        file.write(header)
+        for name, array in arrays.items():
+            file.seek(entries[name]["offset"])
+            file.write(array.data)
+        # make the file as long as the last alignment boundary, mapping needs every byte
+        file.truncate(max(_aligned(_PREFIX.size + len(header)), file.tell()))
+
+
+def load_index(path: str, kind: str, verify: bool = False) -> tuple[dict, dict[str, np.ndarray]]:
+    """
+    Memory-map an index written by save_index. Arrays are read-only views into the mapping,
+    so loading costs the same for any index size and processes mapping the same file share
+    its pages.
+
+    :param kind: Expected index type.
+    :param verify: Also check the crc32 of every array, this reads the whole file.
+    :return: (meta, arrays)
+    """
+    with open(path, "rb") as file:
+        magic, version, header_length, header_crc = _PREFIX.unpack(file.read(_PREFIX.size))
+        header = file.read(header_length)
+
+    if magic != MAGIC:
+        raise IndexFormatError(f"{path} is not an index file")
+    if version != FORMAT_VERSION:
+        raise IndexFormatError(f"{path} has format version {version}, expected {FORMAT_VERSION}")
+    if zlib.crc32(header) != header_crc:
+        raise IndexFormatError(f"{path} has a corrupted header")
+
+    header = json.loads(header)
+    if header["kind"] != kind:
+        raise IndexFormatError(f"{path} holds a {header['kind']}, expected {kind}")
+
+    mapping = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        array = mapping[entry["offset"]:entry["offset"] + count * dtype.itemsize].view(dtype).reshape(entry["shape"])
+        if verify and zlib.crc32(array.data) != entry["crc32"]:
+            raise IndexFormatError(f"{path}: checksum mismatch in array {name}")
+        arrays[name] = array
+
+    return header["meta"], arrays
@@ -0,0 +1,149 @@
+import numpy as np
+
+# results of PolygonIndex.classify
+OUTSIDE = 0
+INSIDE = 1
+PARTIAL = 2
+
+# most horizontal slabs the edges are bucketed into
+MAX_SLABS = 512
+# point x edge pairs tested at once by contains
+_CHUNK_PAIRS = 1 << 20
+_NO_EDGES = np.empty(0, dtype=np.int64)
+
+
+def polygon_vertices(polygon) -> np.ndarray:
+    """
+    Vertices of a query polygon as a (V, 2) array.
+
+    :param polygon: Sequence of (x, y) vertices, or a visualizer Polygon holding a single polygon.
+    """
+    # visualizer.figures.polygon.Polygon keeps its polygons in .data, read it without importing matplotlib
+    if hasattr(polygon, 'data') and hasattr(polygon, 'options'):
+        if len(polygon.data) != 1:
+            raise ValueError(f"expected a single polygon, got {len(polygon.data)}")
+        polygon = polygon.data[0]
+
+    vertices = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+    if len(vertices) < 3:
+        raise ValueError("a polygon needs at least 3 vertices")
+
+    return vertices
+
+
+# Point-in-polygon and box-against-polygon tests for one simple polygon
+# Edges are bucketed into horizontal slabs of equal height, every slab lists the edges whose
+# y range reaches into it. A point is tested by ray casting against the edges of its slab only,
+# a box only against the edges of the slabs it spans or those touching its parent box.
+# Points exactly on an edge may fall either way.
+class PolygonIndex:
+    def __init__(self, polygon, slabs: int = None):
+        """
+        :param polygon: See polygon_vertices, the last vertex connects back to the first.
+        :param slabs: Number of slabs, by default one per edge up to MAX_SLABS.
+        """
+        vertices = polygon_vertices(polygon)
+        self.vertices = vertices
+
+        # (x0, y0, x1, y1) per edge
+        self.edges = np.column_stack((vertices, np.roll(vertices, -1, axis=0)))
+        (self.x_min, self.y_min), (self.x_max, self.y_max) = vertices.min(axis=0), vertices.max(axis=0)
+
+        self.slabs = slabs or min(len(self.edges), MAX_SLABS)
+        self.slab_height = (self.y_max - self.y_min) / self.slabs or 1.0
+
+        # CSR lists of edge ids per slab
+        low = self._slab(np.minimum(self.edges[:, 1], self.edges[:, 3]))
+        high = self._slab(np.maximum(self.edges[:, 1], self.edges[:, 3]))
+        counts = high - low + 1
+        starts = np.repeat(np.cumsum(counts) - counts, counts)
+        slab_ids = np.repeat(low, counts) + np.arange(counts.sum()) - starts
+        order = np.argsort(slab_ids, kind='stable')
+        self.slab_edges = np.repeat(np.arange(len(self.edges)), counts)[order]
+        self.slab_offsets = np.zeros(self.slabs + 1, dtype=np.int64)
+        np.cumsum(np.bincount(slab_ids, minlength=self.slabs), out=self.slab_offsets[1:])
+
+    def _slab(self, y: np.ndarray) -> np.ndarray:
+        return np.clip(((y - self.y_min) / self.slab_height).astype(np.int64), 0, self.slabs - 1)
+
+    def _edges_between(self, y_min: float, y_max: float) -> np.ndarray:
+        # ids of edges reaching into the slabs from y_min to y_max, possibly repeated
+        low, high = self._slab(np.array([y_min, y_max])).tolist()
+        lo, hi = self.slab_offsets[low], self.slab_offsets[high + 1]
+        if hi - lo > len(self.edges):
+            return np.arange(len(self.edges))
+
+        return self.slab_edges[lo:hi]
+
+    def contains(self, points: np.ndarray) -> np.ndarray:
+        """
+        Test which points lie inside the polygon.
+
+        :param points: (N, 2) array, extra columns are ignored.
+        :return: (N,) boolean mask.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(len(points), -1)
+        inside = np.zeros(len(points), dtype=bool)
+        candidates = np.flatnonzero((self.x_min <= points[:, 0]) & (points[:, 0] <= self.x_max) &
+                                    (self.y_min <= points[:, 1]) & (points[:, 1] <= self.y_max))
+        if not len(candidates):
+            return inside
+
+        slab = self._slab(points[candidates, 1])
+        order = np.argsort(slab, kind='stable')
+        candidates, slab = candidates[order], slab[order]
+        bounds = np.flatnonzero(np.diff(slab)) + 1
+        for group in np.split(np.arange(len(candidates)), bounds):
+            s = slab[group[0]]
+            edges = self.edges[self.slab_edges[self.slab_offsets[s]:self.slab_offsets[s + 1]]]
+            step = max(1, _CHUNK_PAIRS // max(len(edges), 1))
+            for chunk in range(0, len(group), step):
+                ids = candidates[group[chunk:chunk + step]]
+                inside[ids] = self._crossings(points[ids, 0], points[ids, 1], edges) % 2 == 1
+
+        return inside
+
+    @staticmethod
+    def _crossings(x: np.ndarray, y: np.ndarray, edges: np.ndarray) -> np.ndarray:
+        # number of edges a ray from every point towards +x crosses
+        x0, y0, x1, y1 = (edges[:, i] for i in range(4))
+        spans = (y0[None, :] > y[:, None]) != (y1[None, :] > y[:, None])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x0[None, :] + (y[:, None] - y0[None, :]) * ((x1 - x0) / (y1 - y0))[None, :]
+        return (spans & (x[:, None] < x_cross)).sum(axis=1)
+
+    def classify(self, x_min: float, x_max: float, y_min: float, y_max: float,
+                 edges: np.ndarray = None) -> tuple[int, np.ndarray]:
+        """
+        Locate a box relative to the polygon.
+
+        :param edges: Ids of the edges that may touch the box, e.g. those returned for an
+                      enclosing box during a tree descent. By default found through the slabs.
+        :return: (OUTSIDE, INSIDE when every point of the box is inside the polygon, or PARTIAL,
+                 ids of the edges touching the box).
+        """
+        if x_max < self.x_min or x_min > self.x_max or y_max < self.y_min or y_min > self.y_max:
+            return OUTSIDE, _NO_EDGES
+
+        if edges is None:
+            edges = self._edges_between(y_min, y_max)
+
+        # Liang-Barsky clipping of the edges against the box
+        e = self.edges[edges]
+        x0, y0 = e[:, 0], e[:, 1]
+        dx, dy = e[:, 2] - x0, e[:, 3] - y0
+        t_enter, t_leave = np.zeros(len(e)), np.ones(len(e))
+        missed = np.zeros(len(e), dtype=bool)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for p, q in ((-dx, x0 - x_min), (dx, x_max - x0), (-dy, y0 - y_min), (dy, y_max - y0)):
+                missed |= (p == 0) & (q < 0)
+                t = q / p
+                t_enter = np.where(p < 0, np.maximum(t_enter, t), t_enter)
+                t_leave = np.where(p > 0, np.minimum(t_leave, t), t_leave)
+        touching = edges[~missed & (t_enter <= t_leave)]
+        if len(touching):
+            return PARTIAL, np.unique(touching)
+
+        # no edge touches the box, so it lies wholly on one side of the boundary
+        center = np.array([[(x_min + x_max) / 2, (y_min + y_max) / 2]])
+        return (INSIDE if self.contains(center)[0] else OUTSIDE), _NO_EDGES
@@ -1,9 +1,28 @@
+import gc
+import heapq
+import itertools
+import math
+
+import numpy as np
+
+from array_utils import chunked, csr
+from persist import load_index, save_index
+from polygon_index import INSIDE, OUTSIDE, PolygonIndex
+from query_stats import QueryStats, shape_summary
+
 GEN_POINT_NUMBER = 64
 QT_NODE_CAPACITY = 4
+# robust mode never subdivides below this depth, extra points overflow the leaf
+QT_MAX_DEPTH = 24
+# points per block yielded by iter_range_chunks
+QT_CHUNK_SIZE = 65536
 
 
 # Axis-aligned bounding box with half dimension and center
+# Edges are computed once on creation, so containment tests are plain float comparisons.
 class AABB:
+    __slots__ = ('center_x', 'center_y', 'half_width', 'half_height', 'x_min', 'x_max', 'y_min', 'y_max')
+
     def __init__(self, center: tuple[float, float], half_width: float, half_height: float):
         """
         Initialize an axis-aligned bounding box (AABB).
@@ -12,10 +31,31 @@ class AABB:
         :param width: The width of the rectangle.
         :param height: The height of the rectangle.
         """
-        self.center = center
+        self.center_x = center[0]
+        self.center_y = center[1]
         self.half_width = half_width
         self.half_height = half_height
 
+        self.x_min = center[0] - half_width
+        self.x_max = center[0] + half_width
+        self.y_min = center[1] - half_height
+        self.y_max = center[1] + half_height
+
+    @staticmethod
+    def from_edges(x_min: float, x_max: float, y_min: float, y_max: float) -> 'AABB':
+        """
+        Box with exactly the given edges, center and half sizes are derived from them.
+
+        :return: An AABB whose x_min, x_max, y_min, y_max are the arguments, unrounded.
+        """
+        box = AABB(((x_min + x_max) / 2, (y_min + y_max) / 2), (x_max - x_min) / 2, (y_max - y_min) / 2)
+        box.x_min, box.x_max, box.y_min, box.y_max = x_min, x_max, y_min, y_max
+        return box
+
+    @property
+    def center(self) -> tuple[float, float]:
+        return self.center_x, self.center_y
+
     def contains_point(self, point: tuple[float, float]) -> bool:
         """
         Check if a point is within the bounds of the rectangle
@@ -23,10 +63,7 @@ class AABB:
         :param point: The point to check.
         :return: True if the point is within the bounds, otherwise False.
         """
-        x_valid = self.center[0] - self.half_width <= point[0] <= self.center[0] + self.half_width
-        y_valid = self.center[1] - self.half_height <= point[1] <= self.center[1] + self.half_height
-
-        return x_valid and y_valid
+        return self.x_min <= point[0] <= self.x_max and self.y_min <= point[1] <= self.y_max
 
     def intersects_AABB(self, other: 'AABB') -> bool:
         """
@@ -36,121 +73,1057 @@ class AABB:
         :param other: The other AABB to check for intersection.
         :return: True if the AABBs intersect, otherwise False.
         """
-        # Calculate the distance between centers
-        dx = abs(other.center[0] - self.center[0])
-        dy = abs(other.center[1] - self.center[1])
+        return (other.x_min <= self.x_max and self.x_min <= other.x_max and
+                other.y_min <= self.y_max and self.y_min <= other.y_max)
+
+    def contains_AABB(self, other: 'AABB') -> bool:
+        """
+        Check if another AABB lies completely inside this one.
 
-        # Check overlap on x-axis and y-axis
-        overlap_x = dx <= (self.half_width + other.half_width)
-        overlap_y = dy <= (self.half_height + other.half_height)
+        :param other: The other AABB to check.
+        :return: True if every point of other is within the bounds, otherwise False.
+        """
+        return (self.x_min <= other.x_min and other.x_max <= self.x_max and
+                self.y_min <= other.y_min and other.y_max <= self.y_max)
 
-        # If both axes overlap, the rectangles intersect
-        return overlap_x and overlap_y
+
+    def quadrants(self) -> list['AABB']:
+        """
+        Split into four boxes of equal area, in the order north_west, north_east, south_west,
+        south_east. Boxes in the same column or row share their coordinate objects.
+        Inner edges are exactly this box's center and outer edges exactly its own edges, so a
+        point routed by comparing against the center (see QuadTree.child_for) always lies in
+        the box it is routed to, however the centers round.
+        """
+        q_width, q_height = self.half_width / 2, self.half_height / 2
+        west, east = self.center_x - q_width, self.center_x + q_width
+        north, south = self.center_y - q_height, self.center_y + q_height
+        columns = [(west, self.x_min, self.center_x), (east, self.center_x, self.x_max)]
+        rows = [(north, self.y_min, self.center_y), (south, self.center_y, self.y_max)]
+
+        boxes = []
+        for center_y, y_min, y_max in rows:
+            for center_x, x_min, x_max in columns:
+                box = AABB.__new__(AABB)
+                box.center_x, box.x_min, box.x_max, box.half_width = center_x, x_min, x_max, q_width
+                box.center_y, box.y_min, box.y_max, box.half_height = center_y, y_min, y_max, q_height
+                boxes.append(box)
+
+        return boxes
+
+    def grown_towards(self, point: tuple[float, float]) -> 'AABB':
+        """
+        Box of twice the size with this one as the quadrant farthest from a point.
+
+        :param point: The point to grow towards, it may still lie outside the result.
+        :return: The grown box. Its center and the edges on this box's side are exactly this
+                 box's edges, so this box is exactly the quadrant quadrants() would give.
+        """
+        east, south = point[0] >= self.center_x, point[1] >= self.center_y
+        grown = AABB((self.x_max if east else self.x_min, self.y_max if south else self.y_min),
+                     self.half_width * 2, self.half_height * 2)
+        if east:
+            grown.x_min = self.x_min
+        else:
+            grown.x_max = self.x_max
+        if south:
+            grown.y_min = self.y_min
+        else:
+            grown.y_max = self.y_max
+
+        return grown
+
+    def distance_squared(self, point: tuple[float, float]) -> float:
+        """
+        Squared distance from a point to the closest point of the rectangle.
+
+        :param point: The point to measure from.
+        :return: 0 when the point is inside the rectangle.
+        """
+        dx = max(self.x_min - point[0], point[0] - self.x_max, 0.0)
+        dy = max(self.y_min - point[1], point[1] - self.y_max, 0.0)
+
+        return dx * dx + dy * dy
+
+    def max_distance_squared(self, point: tuple[float, float]) -> float:
+        """
+        Squared distance from a point to the farthest corner of the rectangle.
+
+        :param point: The point to measure from.
+        :return: The rectangle lies inside a circle around point with at least this squared radius.
+        """
+        dx = max(abs(point[0] - self.x_min), abs(point[0] - self.x_max))
+        dy = max(abs(point[1] - self.y_min), abs(point[1] - self.y_max))
+
+        return dx * dx + dy * dy
+
+
+_EMPTY_SUMMARY = (0, 0.0, float('inf'), float('-inf'))
+# points of every node holding none, a node gets its own list on the first insert
+_NO_POINTS = ()
+
+
+def _tuples(points) -> list[tuple[float, float]]:
+    # bulk-loaded leaves keep their points as a slice of one shared array
+    if isinstance(points, np.ndarray):
+        return list(map(tuple, points.tolist()))
+
+    return points
+
+
+def _points_summary(points: list) -> tuple[int, float, float, float]:
+    if not len(points):
+        return _EMPTY_SUMMARY
+
+    weights = [point[2] if len(point) > 2 else 1.0 for point in points]
+    return len(weights), float(sum(weights)), float(min(weights)), float(max(weights))
+
+
+def _merge_summary(a: tuple, b: tuple) -> tuple[int, float, float, float]:
+    return a[0] + b[0], a[1] + b[1], min(a[2], b[2]), max(a[3], b[3])
 
 
 # QuadTree class
 # This class represents both one quad tree and the node where it is rooted.
 class QuadTree:
-    def __init__(self, boundary: AABB, capacity: int = QT_NODE_CAPACITY):
+    __slots__ = ('qt_node_capacity', 'boundary', 'robust', 'max_depth', 'depth', 'points', 'children', '_summary')
+
+    def __init__(self, boundary: AABB, capacity: int = QT_NODE_CAPACITY, robust: bool = False,
+                 max_depth: int = QT_MAX_DEPTH, depth: int = 0):
         # constant, how many elements can be stored in node
         self.qt_node_capacity = capacity
 
         # represent boundary of this quad tree
         self.boundary = boundary
 
+        # Robust mode routes every point to exactly one child, using half-open boundaries
+        # (x < center goes west, y < center goes north), and stops subdividing at max_depth
+        # or when the points of a leaf are all identical. Such leaves overflow instead.
+        self.robust = robust
+        self.max_depth = max_depth
+        self.depth = depth
+
         # points that this quadTree holds, len(points) <= self.qt_node_capacity
-        self.points = []
+        # unless this is an overflowing leaf in robust mode
+        self.points = _NO_POINTS
         
-        # Childs of this QuadTree Node, they are of type QuadTree
-        self.north_west = None
-        self.north_east = None
-        self.south_west = None
-        self.south_east = None
+        # Childs of this QuadTree Node, None for a leaf, otherwise one list of four QuadTrees
+        # in the order north_west, north_east, south_west, south_east
+        self.children = None
+
+        # (count, weight sum, weight min, weight max) of the whole subtree, built lazily
+        # and dropped again whenever a point is added below this node
+        self._summary = None
+
+    @property
+    def north_west(self) -> 'QuadTree':
+        return self.children[0] if self.children is not None else None
+
+    @property
+    def north_east(self) -> 'QuadTree':
+        return self.children[1] if self.children is not None else None
+
+    @property
+    def south_west(self) -> 'QuadTree':
+        return self.children[2] if self.children is not None else None
+
+    @property
+    def south_east(self) -> 'QuadTree':
+        return self.children[3] if self.children is not None else None
  
     
     def insert(self, point: tuple[float, float]) -> None:
         contains_point = self.boundary.contains_point(point)
 
+        # the root grows towards points outside of it, any other node just ignores them
+        if not contains_point and self.depth == 0:
+            contains_point = self._grow(point)
+
         if not contains_point:
             return
 
+        self._summary = None
+
+        if self.robust:
+            self._insert_robust(point)
+            return
+
         # We hvaen't created children yet and can still put points inside a box
-        if self.north_west is None and len(self.points) < self.qt_node_capacity:
-            self.points.append(point)
+        if self.children is None and len(self.points) < self.qt_node_capacity:
+            self._own_points().append(point)
         # if in point is in range, but we have too much inside current node
         else:
-            if self.north_west is None:
+            if self.children is None:
                 self.subdivide()
 
-            self.north_west.insert(point)
-            self.north_east.insert(point)
-            self.south_west.insert(point)
-            self.south_east.insert(point)
+            for child in self.children:
+                child.insert(point)
  
+    def _insert_robust(self, point: tuple[float, float]) -> None:
+        # the caller already checked that point lies inside this node
+        if self.children is None:
+            if len(self.points) < self.qt_node_capacity or not self._can_split(point):
+                self._own_points().append(point)
+                return
+
+            self.subdivide()
+
+        child = self.child_for(point)
+        child._summary = None
+        child._insert_robust(point)
+
+    def _grow(self, point: tuple[float, float]) -> bool:
+        """
+        Double the root towards a point until it contains the point. Every step moves the
+        current root down to become one quadrant of a new root twice its size. This node stays
+        the root, so references to the tree remain valid.
+
+        :return: False if the point can never fit (not finite, or the root has no area).
+        """
+        if not (math.isfinite(point[0]) and math.isfinite(point[1])):
+            return False
+
+        while not self.boundary.contains_point(point):
+            old = self.boundary
+            if not old.half_width or not old.half_height:
+                return False
+
+            east, south = point[0] >= old.center_x, point[1] >= old.center_y
+            grown = old.grown_towards(point)
+
+            # the old root moves into a node of its own, one level deeper along with its subtree
+            moved = QuadTree(old, capacity=self.qt_node_capacity, robust=self.robust, max_depth=self.max_depth)
+            moved.points, moved.children, moved._summary = self.points, self.children, self._summary
+            stack = [moved]
+            while stack:
+                node = stack.pop()
+                node.depth += 1
+                node.max_depth += 1
+                if node.children is not None:
+                    stack.extend(node.children)
+
+            settings = dict(capacity=self.qt_node_capacity, robust=self.robust, max_depth=self.max_depth + 1, depth=1)
+            self.children = [QuadTree(box, **settings) for box in grown.quadrants()]
+            # the old root lies on the opposite side of the new center than the point
+            self.children[(not south) * 2 + (not east)] = moved
+            self.boundary = grown
+            self.max_depth += 1
+            self.points = _NO_POINTS
+            self._summary = None
+
+            if self.robust:
+                # points on the old box's edge towards the point now lie on the new center lines,
+                # which child_for routes to the quadrants next to the old box
+                def stray(x, y):
+                    return (east and x >= grown.center_x) or (south and y >= grown.center_y)
+
+                strays, stack = [], [moved]
+                while stack:
+                    node = stack.pop()
+                    if node.children is not None:
+                        stack.extend(child for child in node.children if stray(child.boundary.x_max, child.boundary.y_max))
+                    else:
+                        strays.extend(stored for stored in _tuples(node.points) if stray(stored[0], stored[1]))
+                for stored in strays:
+                    moved.remove(stored)
+                    self._insert_robust(stored)
+
+        return True
+
+    def _own_points(self) -> list[tuple[float, float]]:
+        # a list this node may append to, replacing the shared empty tuple or a bulk-loaded slice
+        if not isinstance(self.points, list):
+            self.points = list(_tuples(self.points))
+
+        return self.points
+
+    def _can_split(self, point: tuple[float, float]) -> bool:
+        # subdividing only helps if some stored point differs from the new one
+        if self.depth >= self.max_depth:
+            return False
+
+        # a leaf holding more than capacity points below max_depth only holds copies of one point
+        stored = self.points if len(self.points) <= self.qt_node_capacity else self.points[:1]
+        return any(p[0] != point[0] or p[1] != point[1] for p in stored)
+
+    def child_for(self, point: tuple[float, float]) -> 'QuadTree':
+        """
+        Pick the single child a point belongs to in robust mode, points on the center
+        lines go east/south.
+        """
+        return self.children[(point[1] >= self.boundary.center_y) * 2 + (point[0] >= self.boundary.center_x)]
+
     def subdivide(self) -> None:
         """
         Create 4 children that fully divide this quad into four quads of equal area
         """
-        q_width = self.boundary.half_width / 2
-        q_height = self.boundary.half_height / 2
-
-        # Create child AABBs
-        self.north_west = QuadTree(
-            AABB((self.boundary.center[0] - q_width, self.boundary.center[1] - q_height), q_width, q_height)
-        )
-        self.north_east = QuadTree(
-            AABB((self.boundary.center[0] + q_width, self.boundary.center[1] - q_height), q_width, q_height)
-        )
-        self.south_west = QuadTree(
-            AABB((self.boundary.center[0] - q_width, self.boundary.center[1] + q_height), q_width, q_height)
-        )
-        self.south_east = QuadTree(
-            AABB((self.boundary.center[0] + q_width, self.boundary.center[1] + q_height), q_width, q_height)
-        )
+        # children share the settings of this node
+        settings = dict(capacity=self.qt_node_capacity, robust=self.robust, max_depth=self.max_depth, depth=self.depth + 1)
+        self.children = [QuadTree(box, **settings) for box in self.boundary.quadrants()]
 
         # Split all points of current quadtree to all of its children
-        for point in self.points:
+        for point in _tuples(self.points):
+            if self.robust:
+                self.child_for(point)._insert_robust(point)
+                continue
 
-            self.north_west.insert(point)
-            self.north_east.insert(point)
-            self.south_west.insert(point)
-            self.south_east.insert(point)
+            for child in self.children:
+                child.insert(point)
                 
         # TODO: jk: check if there should be .clear instead of new list assignment
-        self.points = []
+        self.points = _NO_POINTS
 
-    def query_range(self, box: AABB) -> list[tuple[float, float]]:
+    def query_range(self, box: AABB, stats: QueryStats = None) -> list[tuple[float, float]]:
         """
         Find all points that appear within a box
+
+        :param stats: Collector the traversal counters of this query are recorded in.
+        """
+        if stats is None:
+            return list(self._iter_range(box))
+
+        counts = [0, 0, 0, 0]
+        found = list(self._iter_range(box, counts))
+        stats.record(*counts, len(found))
+        return found
+
+    def shape_stats(self) -> dict:
+        """
+        Depth histogram, leaf fill factor against the node capacity and empty leaves,
+        see query_stats.shape_summary.
+        """
+        def nodes():
+            stack = [self]
+            while stack:
+                node = stack.pop()
+                yield node.depth, node.children is None, len(node.points)
+                if node.children is not None:
+                    stack.extend(node.children)
+
+        return shape_summary(nodes(), self.qt_node_capacity)
+
+    def _iter_nodes(self, box: AABB, counts: list[int] = None):
+        # nodes intersecting box, depth first with an explicit stack, each with a flag telling
+        # whether box covers it. Below a covered node nothing is tested any more.
+        # counts, when given, gets the nodes_visited and box_tests of query_stats.COUNTERS added
+        # to its first two items.
+        stack = [(self, False)]
+        while stack:
+            node, covered = stack.pop()
+            if not covered:
+                if not node.boundary.intersects_AABB(box):
+                    if counts is not None:
+                        counts[1] += 1
+                    continue
+                covered = box.contains_AABB(node.boundary)
+                if counts is not None:
+                    counts[1] += 2
+
+            if counts is not None:
+                counts[0] += 1
+            yield node, covered
+            if node.children is not None:
+                stack.extend([(child, covered) for child in reversed(node.children)])
+
+    def iter_range(self, box: AABB, limit: int = None):
+        """
+        Yield the points within a box one by one, without collecting them.
+
+        :param box: The range to search.
+        :param limit: Stop after this many points.
+        """
+        return itertools.islice(self._iter_range(box), limit)
+
+    def _iter_range(self, box: AABB, counts: list[int] = None):
+        # counts, when given, collects nodes_visited, box_tests, points_tested and points_accepted
+        for node, covered in self._iter_nodes(box, counts):
+            points = _tuples(node.points)
+            if counts is not None:
+                counts[3 if covered else 2] += len(points)
+            if covered:
+                yield from points
+            else:
+                yield from (point for point in points if box.contains_point(point))
+
+    def iter_range_chunks(self, box: AABB, chunk_size: int = QT_CHUNK_SIZE, limit: int = None):
+        """
+        Yield the x, y of points within a box as (chunk_size, 2) arrays, the last one shorter.
+        Memory stays at about one chunk whatever the number of matches.
+
+        :param limit: Stop after this many points.
+        """
+        return chunked(self._iter_blocks(box), chunk_size, limit)
+
+    def _iter_blocks(self, box: AABB):
+        for node, covered in self._iter_nodes(box):
+            if not len(node.points):
+                continue
+            if isinstance(node.points, np.ndarray):
+                block = node.points[:, :2]
+            else:
+                block = np.array([(point[0], point[1]) for point in node.points], dtype=np.float64)
+            if not covered:
+                block = block[(box.x_min <= block[:, 0]) & (block[:, 0] <= box.x_max) &
+                              (box.y_min <= block[:, 1]) & (block[:, 1] <= box.y_max)]
+            yield block
+
+    def query_polygon(self, polygon) -> list[tuple[float, float]]:
+        """
+        Find all points inside a polygon. Nodes outside the polygon are skipped, nodes inside
+        it are taken whole, and only points of nodes on its boundary are tested, all at once.
+
+        :param polygon: (x, y) vertices, a visualizer Polygon or a prepared PolygonIndex.
+        """
+        index = polygon if isinstance(polygon, PolygonIndex) else PolygonIndex(polygon)
+        # every node carries the edges touching its parent, the only ones that can touch it
+        found, candidates, stack = [], [], [(self, None)]
+        while stack:
+            node, edges = stack.pop()
+            b = node.boundary
+            where, edges = index.classify(b.x_min, b.x_max, b.y_min, b.y_max, edges)
+            if where == OUTSIDE:
+                continue
+            if where == INSIDE:
+                found.extend(node.all_points())
+                continue
+
+            candidates.extend(_tuples(node.points))
+            if node.children is not None:
+                stack.extend([(child, edges) for child in reversed(node.children)])
+
+        if candidates:
+            mask = index.contains(np.array([(point[0], point[1]) for point in candidates]))
+            found.extend(itertools.compress(candidates, mask.tolist()))
+
+        return found
+
+    def remove(self, point: tuple[float, float]) -> bool:
+        """
+        Remove one stored copy of a point. In robust mode children that end up holding at most
+        capacity points in total are merged back into this node.
+
+        :param point: The point to remove, matched on its coordinates.
+        :return: True if a point was removed, otherwise False.
+        """
+        if not self.boundary.contains_point(point):
+            return False
+
+        if self.children is None:
+            points = _tuples(self.points)
+            for i, stored in enumerate(points):
+                if stored[0] == point[0] and stored[1] == point[1]:
+                    del points[i]
+                    self.points = points
+                    self._summary = None
+                    return True
+            return False
+
+        if self.robust:
+            removed = self.child_for(point).remove(point)
+        else:
+            # border points live in several children, remove them from all of them
+            removed = [child.remove(point) for child in self.children]
+            removed = any(removed)
+
+        if removed:
+            self._summary = None
+            if self.robust:
+                self._merge()
+
+        return removed
+
+    def _merge(self) -> None:
+        # collapse four leaf children back into this node once they fit in it
+        children = self.children
+        if any(child.children is not None for child in children):
+            return
+        if sum(len(child.points) for child in children) > self.qt_node_capacity:
+            return
+
+        self.points = [point for child in children for point in _tuples(child.points)]
+        self.children = None
+
+    def move(self, old: tuple[float, float], new: tuple[float, float]) -> bool:
+        """
+        Move a stored point to a new position. In robust mode a point staying in the same leaf
+        is replaced in place without touching any other node.
+
+        :param old: The stored point to move.
+        :param new: Its new position. Like in insert, the root grows when it falls outside the tree.
+        :return: True if old was found, otherwise False.
         """
-        # Using set will handle cases when point lies on AABB border. In list we would classify it as 2 different points
-        points_in_range = []
+        if self.robust and self.boundary.contains_point(old) and self.boundary.contains_point(new):
+            # walk down both paths while they agree
+            node = self
+            while node.children is not None and node.child_for(old) is node.child_for(new):
+                node = node.child_for(old)
 
-        # if we ranges don't intersect we don't have a match and return empty list
+            if node.children is None:
+                points = _tuples(node.points)
+                for i, stored in enumerate(points):
+                    if stored[0] == old[0] and stored[1] == old[1]:
+                        points[i] = new
+                        node.points = points
+                        # summaries hold weights only, they change only if the weight does
+                        if tuple(stored[2:]) != tuple(new[2:]):
+                            self._drop_summaries(new)
+                        return True
+                return False
+
+        if not self.remove(old):
+            return False
+
+        self.insert(new)
+        return True
+
+    def _drop_summaries(self, point: tuple[float, float]) -> None:
+        node = self
+        while node is not None:
+            node._summary = None
+            node = node.child_for(point) if node.children is not None else None
+
+    def apply_updates(self, batch) -> int:
+        """
+        Apply a batch of point updates, e.g. one tick of a moving-object workload.
+
+        :param batch: Iterable of (old, new) pairs. (None, new) inserts new, (old, None) removes old,
+                      anything else moves old to new.
+        :return: Number of updates that found their old point (inserts always count).
+        """
+        applied = 0
+        for old, new in batch:
+            if old is None:
+                self.insert(new)
+                applied += 1
+            elif new is None:
+                applied += self.remove(old)
+            else:
+                applied += self.move(old, new)
+
+        return applied
+
+    def all_points(self) -> list[tuple[float, float]]:
+        """
+        Collect every point stored in this quad tree, without any bounds checks
+        """
+        points, stack = [], [self]
+        while stack:
+            node = stack.pop()
+            points.extend(_tuples(node.points))
+            if node.children is not None:
+                stack.extend(reversed(node.children))
+
+        return points
+
+    def summary(self) -> tuple[int, float, float, float]:
+        """
+        Count, weight sum, weight min and weight max of all points below this node. The weight
+        of a point is its third element, points stored as plain (x, y) weigh 1.0.
+        """
+        if self._summary is None:
+            summary = _points_summary(self.points)
+            if self.children is not None:
+                for child in self.children:
+                    summary = _merge_summary(summary, child.summary())
+            self._summary = summary
+
+        return self._summary
+
+    def _range_summary(self, box: AABB) -> tuple[int, float, float, float]:
         if not self.boundary.intersects_AABB(box):
-            return points_in_range
+            return _EMPTY_SUMMARY
+
+        # fully covered node answers with its stored summary in O(1)
+        if box.contains_AABB(self.boundary):
+            return self.summary()
+
+        summary = _points_summary([point for point in self.points if box.contains_point(point)])
+        if self.children is not None:
+            for child in self.children:
+                summary = _merge_summary(summary, child._range_summary(box))
+
+        return summary
+
+    def count_range(self, box: AABB) -> int:
+        """
+        Count points that appear within a box, without collecting them
+        """
+        return self._range_summary(box)[0]
+
+    def aggregate_range(self, box: AABB) -> dict[str, float]:
+        """
+        Aggregate the weights of points that appear within a box.
+
+        :param box: The range to aggregate over.
+        :return: count, sum, mean, min and max of the weights, NaN statistics when nothing matches.
+        """
+        count, total, low, high = self._range_summary(box)
+        if not count:
+            return {'count': 0, 'sum': 0.0, 'mean': float('nan'), 'min': float('nan'), 'max': float('nan')}
+
+        return {'count': count, 'sum': total, 'mean': total / count, 'min': low, 'max': high}
+
+    def query_radius(self, center: tuple[float, float], radius: float) -> list[tuple[float, float]]:
+        """
+        Find all points within distance radius of center
+        """
+        r2 = radius * radius
+        points_in_range, stack = [], [self]
+        while stack:
+            node = stack.pop()
+            # circle doesn't reach the node
+            if node.boundary.distance_squared(center) > r2:
+                continue
 
-        for point in self.points:
-            if box.contains_point(point):
-                points_in_range.append(point)
+            # all four corners inside the circle, so is every point below the node
+            if node.boundary.max_distance_squared(center) <= r2:
+                points_in_range.extend(node.all_points())
+                continue
 
-        # We don't have any child nodes, then return        
-        if self.north_west is None:
-            return points_in_range
+            for point in _tuples(node.points):
+                if (point[0] - center[0]) ** 2 + (point[1] - center[1]) ** 2 <= r2:
+                    points_in_range.append(point)
 
-        # add all points from children that are within range
-        for child in [self.north_west, self.north_east, self.south_west, self.south_east]:
-            for point in child.query_range(box):
-                points_in_range.append(point)
+            if node.children is not None:
+                stack.extend(reversed(node.children))
 
         return points_in_range
 
+    def query_radius_many(self, centers: np.ndarray, radii) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Answer many radius queries with one traversal of the tree, see query_many.
+
+        :param centers: (M, 2) array of circle centers.
+        :param radii: one radius for all circles or an (M,) array.
+        :return: (offsets, points) in CSR form, points of circle i are points[offsets[i]:offsets[i+1]].
+        """
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        r2 = np.broadcast_to(np.asarray(radii, dtype=np.float64), (len(centers),)) ** 2
+        query_ids, found = [], []
+
+        stack = [(self, np.arange(len(centers)))]
+        while stack:
+            node, active = stack.pop()
+            b = node.boundary
+            c = centers[active]
+            # distances to the node's own edges, the nearest and the farthest along each axis
+            near_x = np.maximum(np.maximum(b.x_min - c[:, 0], c[:, 0] - b.x_max), 0)
+            near_y = np.maximum(np.maximum(b.y_min - c[:, 1], c[:, 1] - b.y_max), 0)
+            far_x = np.maximum(np.abs(c[:, 0] - b.x_min), np.abs(c[:, 0] - b.x_max))
+            far_y = np.maximum(np.abs(c[:, 1] - b.y_min), np.abs(c[:, 1] - b.y_max))
+
+            # drop circles that don't reach the node
+            near = near_x ** 2 + near_y ** 2 <= r2[active]
+            active, far_x, far_y = active[near], far_x[near], far_y[near]
+            if not len(active):
+                continue
+
+            # circles holding all four corners take every point of the node
+            covered = far_x ** 2 + far_y ** 2 <= r2[active]
+            if covered.any():
+                points = node.all_points()
+                if points:
+                    points = np.asarray(points, dtype=np.float64)
+                    query_ids.append(np.repeat(active[covered], len(points)))
+                    found.append(np.tile(points, (covered.sum(), 1)))
+                active = active[~covered]
+                if not len(active):
+                    continue
+
+            if len(node.points):
+                c = centers[active]
+                points = np.asarray(node.points, dtype=np.float64)
+                distances = (c[:, 0, None] - points[None, :, 0]) ** 2 + (c[:, 1, None] - points[None, :, 1]) ** 2
+                q, p = np.nonzero(distances <= r2[active, None])
+                query_ids.append(active[q])
+                found.append(points[p])
+
+            if node.children is not None:
+                for child in reversed(node.children):
+                    stack.append((child, active))
+
+        return csr(query_ids, found, len(centers), np.empty((0, 2)))
+
+    def knn(self, point: tuple[float, float], k: int) -> list[tuple[float, float]]:
+        """
+        Find the k points closest to a point, nearest first. Nodes are visited best-first by
+        the distance to their boundary and the search stops once no node can beat the k-th
+        best point found so far.
+
+        :param point: The query point.
+        :param k: How many neighbours to return.
+        """
+        if k <= 0:
+            return []
+
+        # max-heap of the best k (negated distances), counter breaks ties between equal keys
+        best = []
+        counter = itertools.count()
+        nodes = [(self.boundary.distance_squared(point), next(counter), self)]
+        while nodes:
+            node_distance, _, node = heapq.heappop(nodes)
+            if len(best) == k and node_distance > -best[0][0]:
+                break
+
+            for candidate in _tuples(node.points):
+                distance = (candidate[0] - point[0]) ** 2 + (candidate[1] - point[1]) ** 2
+                if len(best) < k:
+                    heapq.heappush(best, (-distance, next(counter), candidate))
+                elif distance < -best[0][0]:
+                    heapq.heapreplace(best, (-distance, next(counter), candidate))
+
+            if node.children is None:
+                continue
+
+            for child in node.children:
+                child_distance = child.boundary.distance_squared(point)
+                if len(best) < k or child_distance <= -best[0][0]:
+                    heapq.heappush(nodes, (child_distance, next(counter), child))
+
+        return [candidate for _, _, candidate in sorted(best, key=lambda item: (-item[0], item[1]))]
+
+    def knn_many(self, points: np.ndarray, k: int) -> np.ndarray:
+        """
+        Run knn for every row of an (M, 2) array.
+
+        :return: (M, k, 2) array of neighbours, nearest first, padded with NaN when the tree holds fewer than k points.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        out = np.full((len(points), k, 2), np.nan)
+        for i, point in enumerate(points.tolist()):
+            neighbours = self.knn(point, k)
+            if neighbours:
+                out[i, :len(neighbours)] = np.asarray(neighbours, dtype=np.float64)[:, :2]
+
+        return out
+
+    def query_many(self, rects: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Answer many range queries with one traversal of the tree. Each node is visited once,
+        carrying the queries that still intersect it, and tested against all of them at once.
+
+        :param rects: (M, 4) array, one x_min, x_max, y_min, y_max row per query.
+        :return: (offsets, points) in CSR form, points of query i are points[offsets[i]:offsets[i+1]].
+        """
+        rects = np.asarray(rects, dtype=np.float64).reshape(-1, 4)
+        query_ids, found = [], []
+        self._query_many(rects, np.arange(len(rects)), query_ids, found)
+
+        return csr(query_ids, found, len(rects), np.empty((0, 2)))
+
+    def _query_many(self, rects: np.ndarray, active: np.ndarray, query_ids: list, found: list) -> None:
+        # keep only the queries whose rect intersects this node
+        r = rects[active]
+        b = self.boundary
+        x_min, x_max = b.x_min, b.x_max
+        y_min, y_max = b.y_min, b.y_max
+        active = active[~((r[:, 1] < x_min) | (r[:, 0] > x_max) | (r[:, 3] < y_min) | (r[:, 2] > y_max))]
+        if not len(active):
+            return
 
-def BuildQuadTree(boundary: AABB, node_capacity: int, points: list[tuple[float, float]]) -> QuadTree:
-    qtree = QuadTree(boundary, capacity=node_capacity)
+        # queries covering the whole node take all of its points and stop here
+        r = rects[active]
+        covered = (r[:, 0] <= x_min) & (x_max <= r[:, 1]) & (r[:, 2] <= y_min) & (y_max <= r[:, 3])
+        if covered.any():
+            points = self.all_points()
+            if points:
+                points = np.asarray(points, dtype=np.float64)
+                query_ids.append(np.repeat(active[covered], len(points)))
+                found.append(np.tile(points, (covered.sum(), 1)))
+            active = active[~covered]
+            if not len(active):
+                return
+
+        if len(self.points):
+            r = rects[active]
+            points = np.asarray(self.points, dtype=np.float64)
+            inside = (
+                (r[:, 0, None] <= points[None, :, 0]) & (points[None, :, 0] <= r[:, 1, None]) &
+                (r[:, 2, None] <= points[None, :, 1]) & (points[None, :, 1] <= r[:, 3, None])
+            )
+            q, p = np.nonzero(inside)
+            query_ids.append(active[q])
+            found.append(points[p])
+
+        if self.children is None:
+            return
+
+        for child in self.children:
+            child._query_many(rects, active, query_ids, found)
+
+    def save(self, path: str) -> None:
+        """
+        Write the tree to disk as flat node arrays, reopen it with load_quadtree.
+        Nodes are numbered breadth first so the four children of a node are neighbours,
+        points are laid out depth first so every subtree owns one contiguous run of them.
+        """
+        nodes, children = [self], []
+        for node in nodes:
+            if node.children is None:
+                children.append(-1)
+            else:
+                children.append(len(nodes))
+                nodes.extend(node.children)
+
+        # points with and without a weight may be mixed, missing weights are stored as 1.0
+        width = max([len(point) for node in nodes for point in node.points] or [2])
+        start, own_end, end = (np.zeros(len(nodes), dtype=np.int64) for _ in range(3))
+        rows, stack = [], [0]
+        while stack:
+            i = stack.pop()
+            start[i] = len(rows)
+            rows.extend(tuple(point) + (1.0,) * (width - len(point)) for point in _tuples(nodes[i].points))
+            own_end[i] = len(rows)
+            if children[i] >= 0:
+                stack.extend(range(children[i] + 3, children[i] - 1, -1))
+
+        # the last child's run ends where its parent's run ends, children come after parents
+        for i in range(len(nodes) - 1, -1, -1):
+            end[i] = own_end[i] if children[i] < 0 else end[children[i] + 3]
+
+        edges = np.array([(node.boundary.x_min, node.boundary.x_max, node.boundary.y_min, node.boundary.y_max)
+                          for node in nodes], dtype=np.float64)
+        points = np.array(rows, dtype=np.float64).reshape(-1, width)
+        meta = {'capacity': self.qt_node_capacity, 'robust': self.robust, 'max_depth': self.max_depth}
+        save_index(path, 'quadtree', meta, {'edges': edges, 'children': np.array(children, dtype=np.int64),
+                                            'start': start, 'own_end': own_end, 'end': end, 'points': points})
+
+
+def morton_codes(points: np.ndarray, boundary: AABB, depth: int = QT_MAX_DEPTH) -> np.ndarray:
+    """
+    Compute Z-order keys of points inside boundary. Every level appends the 2-bit quadrant
+    (north_west=0, north_east=1, south_west=2, south_east=3) that robust insertion would pick,
+    using the same center arithmetic as subdivide, so keys agree with the tree exactly.
+
+    :param points: (N, 2) array of points.
+    :param depth: Number of levels, at most 32.
+    :return: (N,) uint64 array of keys.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    x, y = points[:, 0], points[:, 1]
+    center_x = np.full(len(points), float(boundary.center_x))
+    center_y = np.full(len(points), float(boundary.center_y))
+    q_width, q_height = boundary.half_width, boundary.half_height
+    codes = np.zeros(len(points), dtype=np.uint64)
+
+    for _ in range(depth):
+        q_width, q_height = q_width / 2, q_height / 2
+        east, south = x >= center_x, y >= center_y
+        codes = (codes << np.uint64(2)) | (south.astype(np.uint64) << np.uint64(1)) | east.astype(np.uint64)
+        center_x = np.where(east, center_x + q_width, center_x - q_width)
+        center_y = np.where(south, center_y + q_height, center_y - q_height)
+
+    return codes
+
+
+def BulkLoadQuadTree(boundary: AABB, node_capacity: int, points: np.ndarray, max_depth: int = QT_MAX_DEPTH) -> QuadTree:
+    """
+    Build the same tree as BuildQuadTree(..., robust=True) without inserting points one by one.
+    Points are sorted once by their Z-order key, so every node owns a contiguous key range and
+    its children are found with a binary search. Leaves keep their points as slices of that one
+    sorted array.
+
+    :param boundary: Root box, None to fit it to the points. A given box is grown like the root
+                     of BuildQuadTree until it contains every point, the tree shapes only match
+                     when it already did.
+    :param points: (N, 2) array, an extra weight column is carried along.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if not len(points):
+        points = np.empty((0, 2))
+    points = points[np.isfinite(points[:, :2]).all(axis=1)]
+    if boundary is None:
+        boundary = fit_boundary(points)
+
+    # growing towards the corners of the extent, checked in one vectorized pass
+    b = boundary
+    if len(points) and b.half_width and b.half_height:
+        (x_min, y_min), (x_max, y_max) = points[:, :2].min(axis=0).tolist(), points[:, :2].max(axis=0).tolist()
+        for corner in ((x_min, y_min), (x_max, y_max)):
+            while not b.contains_point(corner):
+                b = b.grown_towards(corner)
+    boundary = b
+    points = points[(b.x_min <= points[:, 0]) & (points[:, 0] <= b.x_max) &
+                    (b.y_min <= points[:, 1]) & (points[:, 1] <= b.y_max)]
+
+    codes = morton_codes(points, boundary, max_depth)
+    order = np.argsort(codes, kind='stable')
+    points, codes = points[order], codes[order]
+
+    # the tree holds no reference cycles, pausing the collector saves it rescanning
+    # every node created so far while the tree grows
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _bulk_load(boundary, node_capacity, points, codes, max_depth)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _bulk_load(boundary: AABB, node_capacity: int, points: np.ndarray, codes: np.ndarray, max_depth: int) -> QuadTree:
+    # nodes of one depth are planned together, leaves get their slice and splitting
+    # nodes hand the four key ranges of their quadrants down to the next depth
+    root = QuadTree(boundary, capacity=node_capacity, robust=True, max_depth=max_depth)
+    nodes, lo, hi = [root], np.array([0]), np.array([len(points)])
+    for depth in range(max_depth + 1):
+        # same rule as robust insertion: split a full node unless it is at max depth
+        # or all of its points are copies of one point
+        split = hi - lo > node_capacity
+        if depth == max_depth:
+            split[:] = False
+        candidates = np.flatnonzero(split)
+        for i in candidates[codes[lo[candidates]] == codes[hi[candidates] - 1]].tolist():
+            split[i] = (points[lo[i]:hi[i], :2] != points[lo[i], :2]).any()
+
+        for i in np.flatnonzero(~split).tolist():
+            nodes[i].points = points[lo[i]:hi[i]]
+        if not split.any():
+            break
+
+        # keys of a node share their top 2 * depth bits, the next 2 bits pick the child
+        lo, hi = lo[split], hi[split]
+        shift = np.uint64(2 * (max_depth - depth - 1))
+        prefix = (codes[lo] >> (shift + np.uint64(2))) << np.uint64(2)
+        bounds = np.searchsorted(codes, (prefix[:, None] + np.arange(1, 4, dtype=np.uint64)) << shift)
+        lo, hi = np.column_stack((lo, bounds)).ravel(), np.column_stack((bounds, hi)).ravel()
+
+        children = []
+        for i in np.flatnonzero(split).tolist():
+            node = nodes[i]
+            node.subdivide()
+            children.extend(node.children)
+        nodes = children
+
+    return root
+
+
+def fit_boundary(points) -> AABB:
+    """
+    Smallest square box around points, found in one vectorized pass.
+
+    :param points: (N, 2) array or list of (x, y), extra columns are ignored.
+    :return: A box containing every point, 1 wide around the origin if there are none.
+    """
+    if not len(points):
+        return AABB((0.0, 0.0), 0.5, 0.5)
+    points = np.asarray(points, dtype=np.float64).reshape(len(points), -1)[:, :2]
+
+    (x_min, y_min), (x_max, y_max) = points.min(axis=0).tolist(), points.max(axis=0).tolist()
+    center_x, center_y = (x_min + x_max) / 2, (y_min + y_max) / 2
+    # square, so every node splits into square quadrants, and never zero sized, so the root can grow
+    half = max(x_max - x_min, y_max - y_min) / 2 or 0.5
+    # center +- half can round inside the extent, which would drop the points lying on it
+    while center_x - half > x_min or center_x + half < x_max or center_y - half > y_min or center_y + half < y_max:
+        half = float(np.nextafter(half, np.inf))
+
+    return AABB((center_x, center_y), half, half)
+
+
+def BuildQuadTree(boundary: AABB, node_capacity: int, points: list[tuple[float, float]], robust: bool = False,
+                  max_depth: int = QT_MAX_DEPTH) -> QuadTree:
+    """
+    Build a quad tree by inserting points one by one.
+
+    :param boundary: Root box, None to fit it to the points. Points outside a given box make the root grow.
+    """
+    if boundary is None:
+        boundary = fit_boundary(points)
+    qtree = QuadTree(boundary, capacity=node_capacity, robust=robust, max_depth=max_depth)
 
     for point in points:
         qtree.insert(point)
 
     return qtree
   
+
+
+# Read-only quad tree over flat arrays, as written by QuadTree.save
+# Node i covers edges[i] = (x min, x max, y min, y max), its children are
+# children[i] .. children[i] + 3 (-1 for a leaf), its own points are points[start[i]:own_end[i]]
+# and all points of its subtree are points[start[i]:end[i]].
+class FlatQuadTree:
+    def __init__(self, edges: np.ndarray, children: np.ndarray, start: np.ndarray, own_end: np.ndarray,
+                 end: np.ndarray, points: np.ndarray, capacity: int = QT_NODE_CAPACITY, robust: bool = False,
+                 max_depth: int = QT_MAX_DEPTH):
+        self.edges = edges
+        self.children = children
+        self.start = start
+        self.own_end = own_end
+        self.end = end
+        self.points = points
+        self.qt_node_capacity = capacity
+        self.robust = robust
+        self.max_depth = max_depth
+
+        self.boundary = AABB.from_edges(*map(float, edges[0]))
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def _runs(self, box: AABB) -> tuple[list[np.ndarray], list[np.ndarray]]:
+        # walks the tree one depth at a time, testing all nodes of a depth together.
+        # Returns index runs of covered subtrees and of own points that still need a check.
+        box_x_min, box_x_max = box.x_min, box.x_max
+        box_y_min, box_y_max = box.y_min, box.y_max
+        covered_runs, partial_runs = [], []
+        nodes = np.zeros(1, dtype=np.int64)
+        while len(nodes):
+            x_min, x_max, y_min, y_max = self.edges[nodes].T
+            hit = ~((x_max < box_x_min) | (x_min > box_x_max) | (y_max < box_y_min) | (y_min > box_y_max))
+            covered = hit & (box_x_min <= x_min) & (x_max <= box_x_max) & (box_y_min <= y_min) & (y_max <= box_y_max)
+            partial = nodes[hit & ~covered]
+
+            covered_runs.append(nodes[covered])
+            partial_runs.append(partial)
+            partial = partial[self.children[partial] >= 0]
+            nodes = (self.children[partial][:, None] + np.arange(4)).ravel()
+
+        return covered_runs, partial_runs
+
+    def query_range_np(self, box: AABB) -> np.ndarray:
+        """
+        Find all points that appear within a box, as one (K, 2) or (K, 3) array
+        """
+        covered, partial = (np.concatenate(runs) for runs in self._runs(box))
+        blocks = [self.points[self.start[i]:self.end[i]] for i in covered.tolist()]
+        for i in partial.tolist():
+            block = self.points[self.start[i]:self.own_end[i]]
+            if len(block):
+                blocks.append(block[(box.x_min <= block[:, 0]) & (block[:, 0] <= box.x_max) &
+                                    (box.y_min <= block[:, 1]) & (block[:, 1] <= box.y_max)])
+
+        if not blocks:
+            return np.empty((0, self.points.shape[1]))
+
+        return np.concatenate(blocks)
+
+    def query_range(self, box: AABB) -> list[tuple[float, float]]:
+        """
+        Find all points that appear within a box
+        """
+        return list(map(tuple, self.query_range_np(box).tolist()))
+
+    def count_range(self, box: AABB) -> int:
+        """
+        Count points that appear within a box, covered subtrees are counted from their run length
+        """
+        covered, partial = (np.concatenate(runs) for runs in self._runs(box))
+        count = int((self.end[covered] - self.start[covered]).sum())
+        for i in partial.tolist():
+            block = self.points[self.start[i]:self.own_end[i]]
+            count += int(((box.x_min <= block[:, 0]) & (block[:, 0] <= box.x_max) &
+                          (box.y_min <= block[:, 1]) & (block[:, 1] <= box.y_max)).sum())
+
+        return count
+
+
+def load_quadtree(path: str, verify: bool = False) -> FlatQuadTree:
+    """
+    Memory-map a tree written by QuadTree.save. Nothing is read up front, queries page in
+    only the nodes and points they touch.
+
+    :param verify: Check the checksums of all arrays before returning.
+    """
+    meta, arrays = load_index(path, 'quadtree', verify)
+    return FlatQuadTree(capacity=meta['capacity'], robust=meta['robust'], max_depth=meta['max_depth'], **arrays)
@@ -0,0 +1,84 @@
+import numpy as np
+
+# counters every instrumented range query reports, in this order
+COUNTERS = ('nodes_visited', 'box_tests', 'points_tested', 'points_accepted', 'points_returned')
+
+
+# Opt-in collector of traversal counters
+# Pass one as stats= to QuadTree.query_range or kdtree.points_inside_rect. The counters are
+# kept by the traversals that answer every query, so they can't drift from them. Without
+# stats those traversals skip the counting, at the price of one None check per node.
+#   nodes_visited   nodes entered (array KD-tree: index ranges, a leaf bucket counts once)
+#   box_tests       node boxes compared against the query box
+#   points_tested   points compared against the query box one by one
+#   points_accepted points returned untested, because the query box covers their node
+#   points_returned points found
+class QueryStats:
+    def __init__(self, keep_queries: bool = True):
+        """
+        :param keep_queries: Keep the counters of every query, not just the totals.
+        """
+        self.keep_queries = keep_queries
+        self.queries = 0
+        self.totals = dict.fromkeys(COUNTERS, 0)
+        self.per_query = []
+
+    def record(self, nodes_visited: int, box_tests: int, points_tested: int, points_accepted: int,
+               points_returned: int) -> None:
+        counters = dict(zip(COUNTERS, (nodes_visited, box_tests, points_tested, points_accepted, points_returned)))
+        self.queries += 1
+        for name, value in counters.items():
+            self.totals[name] += value
+        if self.keep_queries:
+            self.per_query.append(counters)
+
+    def reset(self) -> None:
+        self.queries = 0
+        self.totals = dict.fromkeys(COUNTERS, 0)
+        self.per_query = []
+
+    @staticmethod
+    def pruning_efficiency(counters: dict[str, int]) -> float:
+        # share of the points a query touched that it returned, 1.0 when nothing was touched in vain
+        touched = counters['points_tested'] + counters['points_accepted']
+        return counters['points_returned'] / touched if touched else 1.0
+
+    def summary(self) -> dict[str, float]:
+        """
+        Aggregate over all recorded queries.
+
+        :return: Totals and per query means of COUNTERS, and the pruning efficiency of the totals.
+        """
+        result = dict(queries=self.queries, **self.totals)
+        for name in COUNTERS:
+            result[f'mean_{name}'] = self.totals[name] / self.queries if self.queries else 0.0
+        result['pruning_efficiency'] = self.pruning_efficiency(self.totals)
+        return result
+
+
+def shape_summary(nodes, capacity: int) -> dict:
+    """
+    Shape statistics of a tree.
+
+    :param nodes: Iterable of (depth, is_leaf, number of points held by the node) for every node.
+    :param capacity: Points a leaf is meant to hold, the leaf fill factor is measured against it.
+    :return: Node, leaf and empty leaf counts, depth histogram (leaves per depth), max depth,
+             mean leaf fill factor and the largest leaf.
+    """
+    depths, sizes, count = [], [], 0
+    for depth, is_leaf, size in nodes:
+        count += 1
+        if is_leaf:
+            depths.append(depth)
+            sizes.append(size)
+
+    depths, sizes = np.asarray(depths, dtype=np.int64), np.asarray(sizes, dtype=np.int64)
+    return {
+        'nodes': count,
+        'leaves': len(sizes),
+        'empty_leaves': int((sizes == 0).sum()),
+        'max_depth': int(depths.max()) if len(depths) else 0,
+        'depth_histogram': np.bincount(depths).tolist() if len(depths) else [],
+        'leaf_fill': float(sizes.mean() / capacity) if len(sizes) else 0.0,
+        'max_leaf_points': int(sizes.max()) if len(sizes) else 0,
+    }
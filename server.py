@@ -0,0 +1,161 @@
+import asyncio
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+
+import numpy as np
+
+from array_utils import as_row
+import kdtree as kd
+
+
+def batch_query(index, rects: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Answer (M, 4) rectangles with one batched traversal of any of the indexes.
+
+    :param index: kd_tree_array, or anything with a query_many(rects) method (QuadTree, ShardedIndex).
+    :return: (offsets, points) in CSR form, points of query i are points[offsets[i]:offsets[i+1]].
+    """
+    if isinstance(index, kd.kd_tree_array):
+        offsets, indices = kd.query_many(rects, index)
+        return offsets, index.points[indices]
+
+    offsets, points = index.query_many(rects)
+    return offsets, points[:, :2]
+
+
+# asyncio front-end of an index
+# Queries arriving within window seconds of each other are answered together by one
+# batch_query call in an executor, so the event loop never runs a traversal itself.
+class AsyncQueryServer:
+    def __init__(self, index, window: float = 0.001, max_batch: int = 1024, max_pending: int = 10000,
+                 executor: Executor = None):
+        """
+        :param index: Tree to serve, see batch_query.
+        :param window: Seconds a query waits for others to join its batch.
+        :param max_batch: A batch is sent as soon as it has this many queries.
+        :param max_pending: Queries accepted but not answered yet, further callers wait for a free slot.
+        :param executor: Runs the traversals, a single thread by default.
+        """
+        self.index = index
+        self.window = window
+        self.max_batch = max_batch
+        self._slots = asyncio.Semaphore(max_pending)
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(1)
+        self._batch = []
+        self._timer = None
+        self._running = set()
+
+        self.batches = 0
+        self.queries = 0
+
+    async def query(self, query) -> np.ndarray:
+        """
+        Find all points within a rectangle without blocking the event loop.
+
+        :param query: kdtree.rect, quadtree.AABB or (x_min, x_max, y_min, y_max).
+        :return: (K, 2) array of the points.
+        """
+        async with self._slots:
+            future = asyncio.get_running_loop().create_future()
+            self._batch.append((as_row(query), future))
+            if len(self._batch) >= self.max_batch:
+                self._flush()
+            elif self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+            return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._batch:
+            return
+
+        batch, self._batch = self._batch, []
+        task = asyncio.ensure_future(self._answer(batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _answer(self, batch: list) -> None:
+        rects = np.array([row for row, _ in batch], dtype=np.float64)
+        try:
+            offsets, points = await asyncio.get_running_loop().run_in_executor(self.executor, batch_query,
+                                                                               self.index, rects)
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        self.batches += 1
+        self.queries += len(batch)
+        for i, (_, future) in enumerate(batch):
+            # callers may have been cancelled while the batch ran
+            if not future.done():
+                future.set_result(points[offsets[i]:offsets[i + 1]])
+
+    async def close(self) -> None:
+        """
+        Answer queued queries, then release the executor if the server created it
+        """
+        self._flush()
+        if self._running:
+            await asyncio.gather(*self._running)
+        if self._own_executor:
+            self.executor.shutdown()
+
+
+def _latency_stats(latencies: list[float], elapsed: float) -> dict[str, float]:
+    latencies = np.asarray(latencies)
+    return {'p50_ms': float(np.percentile(latencies, 50) * 1000), 'p99_ms': float(np.percentile(latencies, 99) * 1000),
+            'throughput_qps': len(latencies) / elapsed}
+
+
+async def _load(ask, rects: np.ndarray, clients: int) -> dict[str, float]:
+    # clients coroutines take turns through rects, each waiting for its answer before asking again
+    latencies, queue = [], iter(rects.tolist())
+
+    async def client():
+        for row in queue:
+            start = time.perf_counter()
+            await ask(row)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    return _latency_stats(latencies, time.perf_counter() - start)
+
+
+async def load_benchmark(index, rects: np.ndarray, clients: int = 64, **server_options) -> dict[str, dict]:
+    """
+    Generate load from concurrent clients and compare direct synchronous calls on the event
+    loop with the coalescing server.
+
+    :param rects: (M, 4) rectangles, every one is asked once per mode.
+    :param clients: Number of concurrent clients.
+    :return: p50/p99 latency in milliseconds and throughput for 'direct' and 'server'.
+    """
+    rects = np.asarray(rects, dtype=np.float64).reshape(-1, 4)
+
+    async def direct(row):
+        await asyncio.sleep(0)
+        return batch_query(index, np.array([row]))
+
+    results = {'direct': await _load(direct, rects, clients)}
+    server = AsyncQueryServer(index, **server_options)
+    results['server'] = await _load(server.query, rects, clients)
+    results['server']['mean_batch'] = server.queries / max(1, server.batches)
+    await server.close()
+
+    return results
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    tree = kd.build_kd_tree_array(rng.random((200000, 2)) * 100, kd.KD_LEAF_SIZE)
+    corners = rng.random((20000, 2)) * 100
+    sizes = rng.random((20000, 2)) * 5
+    queries = np.column_stack((corners[:, 0], corners[:, 0] + sizes[:, 0], corners[:, 1], corners[:, 1] + sizes[:, 1]))
+    for mode, stats in asyncio.run(load_benchmark(tree, queries)).items():
+        print(mode, ', '.join(f'{name}={value:.2f}' for name, value in stats.items()))
@@ -0,0 +1,242 @@
+import multiprocessing
+
+import numpy as np
+
+from array_utils import as_row, csr
+import kdtree as kd
+from quadtree import AABB, QT_NODE_CAPACITY, BulkLoadQuadTree
+
+
+def _uniform_edges(bounds: tuple[float, float, float, float], columns: int, rows: int) -> tuple[np.ndarray, np.ndarray]:
+    # equal tiles, 2 x 2 are the four quadrants QuadTree.subdivide makes of the root
+    x_min, x_max, y_min, y_max = bounds
+    x_edges = np.linspace(x_min, x_max, columns + 1)
+    y_edges = np.tile(np.linspace(y_min, y_max, rows + 1), (columns, 1))
+    return x_edges, y_edges
+
+
+def _density_edges(points: np.ndarray, bounds: tuple[float, float, float, float], columns: int,
+                   rows: int) -> tuple[np.ndarray, np.ndarray]:
+    # columns holding the same number of points, each cut into rows holding the same number of points
+    # a column without points keeps uniform rows
+    x_edges, y_edges = _uniform_edges(bounds, columns, rows)
+    if len(points):
+        x_edges[1:-1] = np.quantile(points[:, 0], np.linspace(0, 1, columns + 1)[1:-1])
+
+    column = np.searchsorted(x_edges[1:-1], points[:, 0], side='right')
+    for c in range(columns):
+        y = points[column == c, 1]
+        if len(y):
+            y_edges[c, 1:-1] = np.quantile(y, np.linspace(0, 1, rows + 1)[1:-1])
+
+    return x_edges, y_edges
+
+
+def _enclosing_box(x_min: float, x_max: float, y_min: float, y_max: float) -> AABB:
+    # center +- half size can round inside the tile edges, which would drop points lying on them
+    center_x, center_y = (x_min + x_max) / 2, (y_min + y_max) / 2
+    half_width, half_height = (x_max - x_min) / 2, (y_max - y_min) / 2
+    while center_x - half_width > x_min or center_x + half_width < x_max:
+        half_width = np.nextafter(half_width, np.inf)
+    while center_y - half_height > y_min or center_y + half_height < y_max:
+        half_height = np.nextafter(half_height, np.inf)
+
+    return AABB((center_x, center_y), float(half_width), float(half_height))
+
+
+def _serve(conn, kind: str, points: np.ndarray, boundary: tuple[float, float, float, float], options: dict) -> None:
+    # worker loop of one shard: build the tree once, then answer batches until told to stop
+    if kind == 'kd':
+        tree = kd.build_kd_tree_array(points, options.get('leaf_size', kd.KD_LEAF_SIZE))
+    else:
+        tree = BulkLoadQuadTree(_enclosing_box(*boundary), options.get('node_capacity', QT_NODE_CAPACITY), points)
+
+    while True:
+        command, payload = conn.recv()
+        if command == 'query':
+            if kind == 'kd':
+                offsets, indices = kd.query_many(payload, tree)
+                conn.send((offsets, tree.points[indices]))
+            else:
+                offsets, found = tree.query_many(payload)
+                conn.send((offsets, found[:, :2]))
+        elif command == 'points':
+            # workers only run for tiles holding points
+            conn.send(tree.points if kind == 'kd' else np.asarray(tree.all_points(), dtype=np.float64)[:, :2])
+        else:
+            conn.close()
+            return
+
+
+# Spatially sharded index
+# The plane is cut into columns and every column into rows, each tile holds its points in
+# its own tree built and queried in a separate worker process. A point belongs to exactly one
+# tile (edges are half-open, a point on an edge goes to the tile above it), a query is sent
+# only to the tiles its rectangle touches, and all tiles answer at the same time.
+class ShardedIndex:
+    def __init__(self, points: np.ndarray, shards: tuple[int, int] = (2, 2), layout: str = 'uniform',
+                 kind: str = 'kd', bounds: tuple[float, float, float, float] = None, **options):
+        """
+        Partition points into tiles and start one worker per non-empty tile.
+
+        :param points: (N, 2) array of points.
+        :param shards: (columns, rows) of the tile grid.
+        :param layout: 'uniform' for equal tiles, 'density' for tiles holding equal point counts.
+        :param kind: Tree built by each worker, 'kd' for kd_tree_array or 'quadtree' for BulkLoadQuadTree.
+        :param bounds: (x_min, x_max, y_min, y_max) covered by the tiles, the points' extent by default.
+        :param options: leaf_size or node_capacity passed on to the tree builds.
+        """
+        if layout not in ('uniform', 'density'):
+            raise ValueError(f"unknown layout {layout!r}")
+        if kind not in ('kd', 'quadtree'):
+            raise ValueError(f"unknown tree kind {kind!r}")
+
+        self.kind = kind
+        self.options = options
+        self.workers = []
+        self._start(np.asarray(points, dtype=np.float64).reshape(-1, 2), shards, layout, bounds)
+
+    def _start(self, points: np.ndarray, shards: tuple[int, int], layout: str,
+               bounds: tuple[float, float, float, float]) -> None:
+        if bounds is None:
+            if len(points):
+                (x_min, y_min), (x_max, y_max) = points.min(axis=0), points.max(axis=0)
+                bounds = (float(x_min), float(x_max), float(y_min), float(y_max))
+            else:
+                bounds = (0.0, 0.0, 0.0, 0.0)
+        x_min, x_max, y_min, y_max = bounds
+        points = points[(x_min <= points[:, 0]) & (points[:, 0] <= x_max) &
+                        (y_min <= points[:, 1]) & (points[:, 1] <= y_max)]
+
+        columns, rows = shards
+        self.shards, self.layout, self.bounds = (columns, rows), layout, bounds
+        if layout == 'uniform':
+            self.x_edges, self.y_edges = _uniform_edges(bounds, columns, rows)
+        else:
+            self.x_edges, self.y_edges = _density_edges(points, bounds, columns, rows)
+
+        # (x_min, x_max, y_min, y_max) of every tile, tile id is column * rows + row
+        self.tiles = np.array([(self.x_edges[c], self.x_edges[c + 1], self.y_edges[c, r], self.y_edges[c, r + 1])
+                               for c in range(columns) for r in range(rows)])
+        shard = self.shard_of(points)
+        self.sizes = np.bincount(shard, minlength=len(self.tiles))
+
+        context = multiprocessing.get_context()
+        self.workers = [None] * len(self.tiles)
+        for i in np.flatnonzero(self.sizes).tolist():
+            parent, child = context.Pipe()
+            process = context.Process(target=_serve, args=(child, self.kind, points[shard == i],
+                                                           tuple(self.tiles[i].tolist()), self.options), daemon=True)
+            process.start()
+            child.close()
+            self.workers[i] = (process, parent)
+
+    def __len__(self) -> int:
+        return int(self.sizes.sum())
+
+    def __enter__(self) -> 'ShardedIndex':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def shard_of(self, points: np.ndarray) -> np.ndarray:
+        """
+        Tile id of every point of an (N, 2) array
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        column = np.searchsorted(self.x_edges[1:-1], points[:, 0], side='right')
+        row = np.zeros(len(points), dtype=np.int64)
+        for c in np.unique(column).tolist():
+            mask = column == c
+            row[mask] = np.searchsorted(self.y_edges[c, 1:-1], points[mask, 1], side='right')
+
+        return column * self.shards[1] + row
+
+    def query_many(self, rects: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Answer a batch of range queries. Every shard gets the queries overlapping its tile as
+        one batch, all shards work in parallel and the answers are merged per query.
+
+        :param rects: (M, 4) array, one x_min, x_max, y_min, y_max row per query.
+        :return: (offsets, points) in CSR form, points of query i are points[offsets[i]:offsets[i+1]].
+        """
+        rects = np.asarray(rects, dtype=np.float64).reshape(-1, 4)
+        t = self.tiles
+        overlap = ~((rects[:, None, 1] < t[None, :, 0]) | (rects[:, None, 0] > t[None, :, 1]) |
+                    (rects[:, None, 3] < t[None, :, 2]) | (rects[:, None, 2] > t[None, :, 3]))
+
+        routed = []
+        for i, worker in enumerate(self.workers):
+            active = np.flatnonzero(overlap[:, i])
+            if worker is not None and len(active):
+                worker[1].send(('query', rects[active]))
+                routed.append((active, worker[1]))
+
+        query_ids, found = [], []
+        for active, conn in routed:
+            offsets, points = conn.recv()
+            query_ids.append(np.repeat(active, np.diff(offsets)))
+            found.append(points)
+
+        return csr(query_ids, found, len(rects), np.empty((0, 2)))
+
+    def query_range(self, query) -> np.ndarray:
+        """
+        Find all points that appear within a rectangle, as one (K, 2) array
+
+        :param query: kdtree.rect, quadtree.AABB or (x_min, x_max, y_min, y_max).
+        """
+        return self.query_many([as_row(query)])[1]
+
+    def query_stream(self, rects, batch_size: int = 256):
+        """
+        Answer an iterable of rectangles in batches of batch_size, yielding one (K, 2) array per rectangle
+        """
+        batch = []
+        for query in rects:
+            batch.append(query)
+            if len(batch) == batch_size:
+                yield from self._split(batch)
+                batch = []
+        if batch:
+            yield from self._split(batch)
+
+    def _split(self, batch: list) -> list[np.ndarray]:
+        offsets, points = self.query_many(batch)
+        return [points[offsets[i]:offsets[i + 1]] for i in range(len(batch))]
+
+    def points(self) -> np.ndarray:
+        """
+        Collect the points of all shards
+        """
+        blocks = []
+        for worker in self.workers:
+            if worker is not None:
+                worker[1].send(('points', None))
+                blocks.append(worker[1].recv())
+
+        return np.concatenate(blocks) if blocks else np.empty((0, 2))
+
+    def rebalance(self, shards: tuple[int, int] = None, layout: str = 'density') -> None:
+        """
+        Recompute tiles from the density of the indexed points and rebuild the shards.
+
+        :param shards: New (columns, rows), the current grid by default.
+        :param layout: Layout of the new tiles, see __init__.
+        """
+        points = self.points()
+        self.close()
+        self._start(points, shards or self.shards, layout, self.bounds)
+
+    def close(self) -> None:
+        """
+        Stop all workers
+        """
+        for worker in self.workers:
+            if worker is not None:
+                process, conn = worker
+                conn.send(('stop', None))
+                conn.close()
+                process.join()
+        self.workers = []
@@ -1,8 +1,17 @@
 import viss
 import quadtree as qt
+import linear_quadtree as lqt
 import kdtree as kd
+import query_stats
+import auto_index as auto
+import server
+from cache import QueryCache
 import numpy as np
+import asyncio
+import os
+import tempfile
 import time
+import tracemalloc
 import typing
 
 TIME_OUT_PRECISION=3
@@ -31,6 +40,21 @@ def measure_func(title, func: typing.Callable[..., T], *args, **kwargs) -> tuple
     return out, total_time
 
 
+def measure_memory(title, func: typing.Callable[..., T], points_count: int, *args, **kwargs) -> tuple[T, float]:
+    """
+    Takes function that builds a structure and measures memory it keeps allocated, scaled to 1M points
+    """
+    tracemalloc.start()
+    out = func(*args, **kwargs)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    per_million = size * 1_000_000 / max(points_count, 1)
+    print(f"{title}:{DELIMITER}{round(per_million / 2**20, TIME_OUT_PRECISION)} MB per 1M points")
+
+    return out, per_million
+
+
 def generate_points(gen_func: typing.Callable, num_points: int, range_min, range_max) -> list[tuple[float, float]]:
     """
     Generate points for both QuadTree and KDTree, respecting both data structures desired input. 
@@ -73,13 +97,8 @@ def test_random(count=200, capacity=1):
 def test_normal_dist(count=200, capacity=1):
     points = generate_points(np.random.normal, count, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)
 
-    # Build and measure QuadTree init time
-    qtree, _ = measure_func("QuadTree build time", qt.BuildQuadTree, qt.AABB(
-            (DEFAULT_AABB_CENTER_X, DEFAULT_AABB_CENTER_Y), POINT_GEN_UPPER_BOUND/2, POINT_GEN_UPPER_BOUND/2
-        ),
-        capacity,
-        points=points
-    )
+    # Build and measure QuadTree init time, most points fall outside 0..100 so the boundary is fitted to them
+    qtree, _ = measure_func("QuadTree build time", qt.BuildQuadTree, None, capacity, points=points)
 
     # Build and measure KDTree init time
     kdtree, _ = measure_func("KDTree build time", kd.build_kd_tree, points)
@@ -98,7 +117,8 @@ def test_normal_dist(count=200, capacity=1):
     # Measure time for query in KDTree
     kd_out, _ = measure_func("Measure KDTree query time", kd.points_inside_rect, rect_section, kdtree)
 
-    return set(q_out) == set(kd_out)
+    # the fitted root must keep every point, extreme ones included
+    return set(q_out) == set(kd_out) and len(qtree.all_points()) == len(points)
 
 def test_clusters(count=200, capacity=1):
     """
@@ -116,7 +136,8 @@ def test_clusters(count=200, capacity=1):
             (DEFAULT_AABB_CENTER_X, DEFAULT_AABB_CENTER_Y), POINT_GEN_UPPER_BOUND/2, POINT_GEN_UPPER_BOUND/2
         ),
         capacity,
-        points=points
+        points=points,
+        robust=True
     )
 
     # Build and measure KDTree init time
@@ -190,7 +211,8 @@ def test_cross(count=200, capacity=1):
             (25, 50), 25, 50
         ),
         capacity,
-        points=points
+        points=points,
+        robust=True
     )
 
     # Build and measure KDTree init time
@@ -243,8 +265,675 @@ def test_viss(count=200, capacity=1):
 
 
 
+def test_kd_buckets(count=200, capacity=1):
+    """
+    Compare per-node KDTree traversal with the bucketed array KDTree on a wide query
+    """
+    points = generate_points(np.random.uniform, count, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)
+
+    # Build and measure both KDTree variants
+    kdtree, _ = measure_func("KDTree build time", kd.build_kd_tree, points)
+    kd_buckets, _ = measure_func("Bucketed KDTree build time", kd.build_kd_tree_array, np.array(points), kd.KD_LEAF_SIZE)
+
+    # x_min, x_max, y_min, y_max
+    section = 10, 90, 10, 90
+    rect_section = kd.rect(section[0], section[1], section[2], section[3])
+
+    # Measure time for query in both KDTrees
+    kd_out, _ = measure_func("Measure KDTree query time", kd.points_inside_rect, rect_section, kdtree)
+    kd_buckets_out, _ = measure_func("Measure bucketed KDTree query time", kd.points_inside_rect_np, rect_section, kd_buckets)
+
+    return set(kd_out) == set(map(tuple, kd_buckets_out.tolist()))
+
+
+def test_knn(count=200, capacity=1, k=10):
+    """
+    Compare k-nearest-neighbour query time of QuadTree and KDTree
+    """
+    points = generate_points(np.random.uniform, count, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)
+
+    # Build and measure QuadTree init time
+    qtree, _ = measure_func("QuadTree build time", qt.BuildQuadTree, qt.AABB(
+            (DEFAULT_AABB_CENTER_X, DEFAULT_AABB_CENTER_Y), POINT_GEN_UPPER_BOUND/2, POINT_GEN_UPPER_BOUND/2
+        ),
+        capacity,
+        points=points
+    )
+
+    # Build and measure KDTree init time
+    kdtree, _ = measure_func("KDTree build time", kd.build_kd_tree, points)
+
+    query_point = (37, 42)
+
+    # Measure time for knn query in QuadTree
+    q_out, _ = measure_func("Measure QuadTree knn time", qtree.knn, query_point, k)
+
+    # Measure time for knn query in KDTree
+    kd_out, _ = measure_func("Measure KDTree knn time", kd.knn, query_point, k, kdtree)
+
+    # Both trees have to find neighbours at the same distances
+    distance = lambda point: (point[0] - query_point[0]) ** 2 + (point[1] - query_point[1]) ** 2
+    return [distance(point) for point in q_out] == [distance(point) for point in kd_out]
+
+
+def test_linear_quadtree(count=200, capacity=1):
+    """
+    Compare pointer based QuadTree with the linear (sorted Morton key) QuadTree
+    """
+    points = generate_points(np.random.uniform, count, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)
+    boundary = qt.AABB(
+        (DEFAULT_AABB_CENTER_X, DEFAULT_AABB_CENTER_Y), POINT_GEN_UPPER_BOUND/2, POINT_GEN_UPPER_BOUND/2
+    )
+
+    # Build and measure both QuadTree variants
+    qtree, _ = measure_func("QuadTree build time", qt.BuildQuadTree, boundary, capacity, points=points, robust=True)
+    linear_qtree, _ = measure_func("Linear QuadTree build time", lqt.BuildLinearQuadTree, boundary, capacity, np.array(points))
+    print(f"Linear QuadTree bytes per point:{DELIMITER}{linear_qtree.nbytes / max(len(linear_qtree), 1)}")
+
+    # x_min, x_max, y_min, y_max
+    section = 2, 38, 5, 35
+    # convert section representation to AABB representation
+    rect_aabb = qt.AABB(((section[0] + section[1])/2 , (section[2] + section[3])/2),
+                        (section[1] - section[0])/2, (section[3] - section[2])/2)
+
+    # Measure time for query in both QuadTrees
+    q_out, _ = measure_func("Measure QuadTree query time", qtree.query_range, rect_aabb)
+    linear_out, _ = measure_func("Measure Linear QuadTree query time", linear_qtree.query_range, rect_aabb)
+
+    return sorted(q_out) == sorted(linear_out)
+
+
+def test_point_lookup(count=200, capacity=1):
+    """
+    Every inserted point has to come back from a point query, also points on the center lines
+    of a root box whose edges and centers don't round evenly
+    """
+    boundary = qt.AABB((3.0, 5.22), 4.77, 4.77)
+    points = generate_points(np.random.uniform, count, 0.5, 7.5)
+    # points on the vertical and horizontal center line of the root and of the first quadrants
+    points += [(3.0, y) for _, y in points[:count // 4]] + [(x, 5.22) for x, _ in points[:count // 4]]
+    points += [(3.0 - 4.77 / 2, y) for _, y in points[:count // 8]]
+
+    qtree, _ = measure_func("QuadTree build time", qt.BuildQuadTree, boundary, capacity, points=points, robust=True)
+    bulk_qtree, _ = measure_func("Bulk QuadTree build time", qt.BulkLoadQuadTree, boundary, capacity, np.array(points))
+    linear_qtree, _ = measure_func("Linear QuadTree build time", lqt.BuildLinearQuadTree, boundary, capacity, np.array(points))
+
+    def found_by_all(point):
+        box = qt.AABB(point, 0, 0)
+        return all(point in tree.query_range(box) for tree in (qtree, bulk_qtree, linear_qtree))
+
+    found, _ = measure_func("Point queries time", lambda: all(found_by_all(point) for point in points))
+    return found
+
+
+def test_memory(count=200, capacity=1):
+    """
+    Measure memory held by QuadTree and KDTree nodes, points themselves are allocated beforehand
+    """
+    points = generate_points(np.random.uniform, count, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)
+    boundary = qt.AABB(
+        (DEFAULT_AABB_CENTER_X, DEFAULT_AABB_CENTER_Y), POINT_GEN_UPPER_BOUND/2, POINT_GEN_UPPER_BOUND/2
+    )
+
+    qtree, _ = measure_memory("QuadTree memory", qt.BuildQuadTree, count, boundary, capacity, points=points, robust=True)
+    kdtree, _ = measure_memory("KDTree memory", kd.build_kd_tree, count, points)
+
+    # x_min, x_max, y_min, y_max
+    section = 2, 38, 5, 35
+    rect_section = kd.rect(section[0], section[1], section[2], section[3])
+    # convert section representation to AABB representation
+    rect_aabb = qt.AABB(((section[0] + section[1])/2 , (section[2] + section[3])/2),
+                        (section[1] - section[0])/2, (section[3] - section[2])/2)
+
+    return set(qtree.query_range(rect_aabb)) == set(kd.points_inside_rect(rect_section, kdtree))
+
+
+def test_grow_root(count=200, capacity=1):
+    """
+    Insert points from outside the root boundary, the root grows instead of dropping them
+    """
+    points = generate_points(np.random.normal, count, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)
+    qtree = qt.QuadTree(qt.AABB(
+        (DEFAULT_AABB_CENTER_X, DEFAULT_AABB_CENTER_Y), POINT_GEN_UPPER_BOUND/2, POINT_GEN_UPPER_BOUND/2
+    ), capacity=capacity, robust=True)
+    measure_func("QuadTree insert time", lambda: [qtree.insert(point) for point in points])
+    kdtree, _ = measure_func("KDTree build time", kd.build_kd_tree, points)
+
+    # x_min, x_max, y_min, y_max
+    section = -150, 30, -80, 120
+    rect_section = kd.rect(section[0], section[1], section[2], section[3])
+    # convert section representation to AABB representation
+    rect_aabb = qt.AABB(((section[0] + section[1])/2 , (section[2] + section[3])/2),
+                        (section[1] - section[0])/2, (section[3] - section[2])/2)
+
+    q_out, _ = measure_func("Measure QuadTree query time", qtree.query_range, rect_aabb)
+    kd_out, _ = measure_func("Measure KDTree query time", kd.points_inside_rect, rect_section, kdtree)
+
+    # the extreme points are the ones a too small or badly rounded root loses
+    same = set(q_out) == set(kd_out) and len(qtree.all_points()) == len(points)
+
+    # a fitted root keeps the extreme points on its edges, which become center lines once it grows
+    fitted_qtree = qt.BuildQuadTree(None, capacity, points=points, robust=True)
+    far_points = [(x + 1000, y + 1000) for x, y in points[:10]] + [(x - 1000, y - 1000) for x, y in points[:10]]
+    measure_func("QuadTree grow time", lambda: [fitted_qtree.insert(point) for point in far_points])
+
+    # every point must still be found where the tree routes it
+    moved = measure_func("QuadTree move time", lambda: all([fitted_qtree.move(point, (point[0] + 1, point[1])) for point in points]))[0]
+    removed = measure_func("QuadTree remove time", lambda: all([qtree.remove(point) for point in points]))[0]
+
+    # the corner points of this fitted root lie exactly on its edges
+    small_qtree = qt.BuildQuadTree(None, 1, points=[(0, 0), (10, 10), (3, 7), (5, 2), (7, 3)], robust=True)
+    small_qtree.insert((50, 5))
+    removed = removed and small_qtree.remove((10, 10)) and small_qtree.move((0, 0), (1, 1))
+
+    return same and moved and removed and not qtree.all_points()
+
+
+def test_dynamic_updates(count=200, capacity=1):
+    """
+    Run random inserts, removes and moves on the dynamic trees, then compare them with trees
+    built from scratch over the points still alive
+    """
+    points = generate_points(np.random.uniform, count, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)
+    boundary = qt.AABB(
+        (DEFAULT_AABB_CENTER_X, DEFAULT_AABB_CENTER_Y), POINT_GEN_UPPER_BOUND/2, POINT_GEN_UPPER_BOUND/2
+    )
+
+    dynamic_kdtree = kd.dynamic_kd_tree(points)
+    qtree = qt.BuildQuadTree(boundary, capacity, points=points, robust=True)
+    batched_qtree = qt.BuildQuadTree(boundary, capacity, points=points, robust=True)
+
+    # (old, new) updates in apply_updates form, missing points are removed and moved too
+    live, updates = list(points), []
+    for _ in range(count):
+        new = generate_points(np.random.uniform, 1, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)[0]
+        old = live.pop(np.random.randint(len(live))) if live and np.random.uniform() < 0.9 else new
+        kind = np.random.randint(3)
+        if kind == 0:
+            updates.append((None, new))
+            live.append(new)
+            if old is not new:
+                live.append(old)
+        elif kind == 1:
+            updates.append((old, None))
+        else:
+            updates.append((old, new))
+            if old is not new:
+                live.append(new)
+
+    def update_one_by_one():
+        for old, new in updates:
+            if old is None:
+                dynamic_kdtree.insert(new)
+                qtree.insert(new)
+            elif new is None:
+                dynamic_kdtree.delete(old)
+                qtree.remove(old)
+            else:
+                dynamic_kdtree.move(old, new)
+                qtree.move(old, new)
+
+    measure_func("Dynamic KDTree and QuadTree update time", update_one_by_one)
+    measure_func("QuadTree apply_updates time", batched_qtree.apply_updates, updates)
+
+    fresh_kdtree, _ = measure_func("KDTree rebuild time", kd.build_kd_tree, list(live))
+    fresh_qtree, _ = measure_func("QuadTree rebuild time", qt.BuildQuadTree, boundary, capacity, points=live, robust=True)
+
+    same = (len(dynamic_kdtree) == len(live) and sorted(qtree.all_points()) == sorted(live) and
+            sorted(batched_qtree.all_points()) == sorted(live))
+    for _ in range(20):
+        x_min, x_max = sorted(np.random.uniform(POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND, 2))
+        y_min, y_max = sorted(np.random.uniform(POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND, 2))
+        rect_section = kd.rect(x_min, x_max, y_min, y_max)
+        rect_aabb = qt.AABB.from_edges(x_min, x_max, y_min, y_max)
+
+        expected = sorted(kd.points_inside_rect(rect_section, fresh_kdtree))
+        same = (same and expected == sorted(fresh_qtree.query_range(rect_aabb)) and
+                expected == sorted(dynamic_kdtree.points_inside_rect(rect_section)) and
+                expected == sorted(qtree.query_range(rect_aabb)) and
+                expected == sorted(batched_qtree.query_range(rect_aabb)))
+
+    return same
+
+
+def test_persist(count=200, capacity=1):
+    """
+    Save and load every index kind, small and empty ones included, and compare query results
+    """
+    boundary = qt.AABB(
+        (DEFAULT_AABB_CENTER_X, DEFAULT_AABB_CENTER_Y), POINT_GEN_UPPER_BOUND/2, POINT_GEN_UPPER_BOUND/2
+    )
+    section = 2, 38, 5, 35
+    rect_section = kd.rect(*section)
+    rect_aabb = qt.AABB.from_edges(*section)
+    path = os.path.join(tempfile.mkdtemp(), "index")
+
+    same = True
+    # header lengths around the sizes whose array offsets shift by an alignment step
+    for n in list(range(0, 34)) + [51, 389, 399, count]:
+        points = np.array(generate_points(np.random.uniform, n, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)).reshape(-1, 2)
+        weights = np.random.uniform(0, 1, n)
+        for tree in (kd.build_kd_tree_array(points.copy(), capacity),
+                     kd.build_kd_tree_array(points.copy(), capacity, weights=weights)):
+            kd.save_kd_tree(tree, path)
+            loaded = kd.load_kd_tree(path, verify=True)
+            same = same and sorted(kd.points_inside_rect(rect_section, tree)) == sorted(kd.points_inside_rect(rect_section, loaded))
+            same = same and kd.count_range(rect_section, tree) == kd.count_range(rect_section, loaded)
+            if tree.weights is not None and n:
+                same = same and kd.aggregate_range(rect_section, tree)['sum'] == kd.aggregate_range(rect_section, loaded)['sum']
+
+        qtree = qt.BuildQuadTree(boundary, capacity, points=list(map(tuple, points.tolist())), robust=True)
+        qtree.save(path)
+        same = same and sorted(qtree.query_range(rect_aabb)) == sorted(qt.load_quadtree(path, verify=True).query_range(rect_aabb))
+
+        linear_qtree = lqt.BuildLinearQuadTree(boundary, capacity, points)
+        linear_qtree.save(path)
+        loaded = lqt.LinearQuadTree.load(path, verify=True)
+        same = same and sorted(linear_qtree.query_range(rect_aabb)) == sorted(loaded.query_range(rect_aabb))
+
+    return same
+
+
+def test_parallel_build(count=200, capacity=1):
+    """
+    The parallel array KDTree build has to give the same tree as the serial one
+    """
+    # smaller inputs are always built serially
+    points = np.random.uniform(POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND, (max(count, kd.KD_PARALLEL_MIN), 2))
+    # rounding gives long runs of equal coordinates
+    points[::3] = points[::3].round()
+
+    serial, _ = measure_func("Array KDTree build time", kd.build_kd_tree_array, points.copy(), capacity)
+    parallel, _ = measure_func("Parallel array KDTree build time", kd.build_kd_tree_array, points.copy(), capacity, workers=4)
+
+    return all(np.array_equal(getattr(serial, name), getattr(parallel, name))
+               for name in ('points', 'index', 'split_axis', 'split_value'))
+
+
+def test_query_stats(count=200, capacity=1):
+    """
+    Compare the QuadTree traversal counters with node and point counts found by brute force
+    """
+    points = generate_points(np.random.uniform, count, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)
+    boundary = qt.AABB(
+        (DEFAULT_AABB_CENTER_X, DEFAULT_AABB_CENTER_Y), POINT_GEN_UPPER_BOUND/2, POINT_GEN_UPPER_BOUND/2
+    )
+    qtree = qt.BuildQuadTree(boundary, capacity, points=points, robust=True)
+    kdtree = kd.build_kd_tree_array(np.array(points), capacity)
+
+    nodes, stack = [], [qtree]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.children or [])
+
+    same = True
+    for section in [(2, 38, 5, 35), (0, 100, 0, 100), (-10, -5, 40, 60), (49, 51, 0, 100)]:
+        rect_aabb = qt.AABB.from_edges(*section)
+        stats = query_stats.QueryStats()
+        found, _ = measure_func("Measure counted QuadTree query time", qtree.query_range, rect_aabb, stats)
+
+        # a node is entered exactly when it intersects the box: below a covered node every node does
+        entered = [node for node in nodes if node.boundary.intersects_AABB(rect_aabb)]
+        inside = [point for point in points if rect_aabb.contains_point(point)]
+        counters = stats.per_query[0]
+        same = (same and counters['nodes_visited'] == len(entered) and
+                counters['points_tested'] + counters['points_accepted'] == sum(len(node.points) for node in entered) and
+                counters['points_returned'] == len(found) == len(inside))
+
+        kd_stats = query_stats.QueryStats()
+        kd_found = kd.points_inside_rect(kd.rect(*section), kdtree, kd_stats)
+        same = same and kd_stats.per_query[0]['points_returned'] == len(kd_found) == len(inside)
+
+    return same
+
+
+def test_polygon(count=200, capacity=1):
+    """
+    Compare polygon queries of both trees with a brute force ray cast, for a concave polygon
+    and for one whose vertices are points of the data
+    """
+    points = generate_points(np.random.uniform, count, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)
+    boundary = qt.AABB(
+        (DEFAULT_AABB_CENTER_X, DEFAULT_AABB_CENTER_Y), POINT_GEN_UPPER_BOUND/2, POINT_GEN_UPPER_BOUND/2
+    )
+    qtree = qt.BuildQuadTree(boundary, capacity, points=points, robust=True)
+    kdtree = kd.build_kd_tree(points)
+    kdtree_array = kd.build_kd_tree_array(np.array(points), capacity)
+
+    # U shape opening upwards
+    concave = [(10, 10), (90, 10), (90, 90), (70, 90), (70, 30), (30, 30), (30, 90), (10, 90)]
+    # star shaped polygon through data points, sorted by their angle around the center
+    corners = points[:7]
+    on_points = sorted(corners, key=lambda p: np.arctan2(p[1] - DEFAULT_AABB_CENTER_Y, p[0] - DEFAULT_AABB_CENTER_X))
+
+    def brute_force(polygon):
+        # points strictly inside by ray casting, and points on an edge that may fall either way
+        inside, border = set(), set()
+        edges = list(zip(polygon, polygon[1:] + polygon[:1]))
+        for x, y in points:
+            on_edge = False
+            crossings = 0
+            for (x0, y0), (x1, y1) in edges:
+                if (abs((x1 - x0) * (y - y0) - (y1 - y0) * (x - x0)) <= 1e-9 * (abs(x1 - x0) + abs(y1 - y0)) and
+                        min(x0, x1) <= x <= max(x0, x1) and min(y0, y1) <= y <= max(y0, y1)):
+                    on_edge = True
+                if (y0 > y) != (y1 > y) and x < x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+                    crossings += 1
+            if on_edge:
+                border.add((x, y))
+            elif crossings % 2:
+                inside.add((x, y))
+        return inside, border
+
+    same = True
+    for polygon in (concave, on_points):
+        inside, border = brute_force(polygon)
+        for title, query in (("QuadTree", lambda: qtree.query_polygon(polygon)),
+                             ("KDTree", lambda: kd.query_polygon(polygon, kdtree)),
+                             ("Array KDTree", lambda: kd.query_polygon(polygon, kdtree_array))):
+            found, _ = measure_func(f"Measure {title} polygon query time", query)
+            found = set(found)
+            same = same and inside <= found <= inside | border
+
+    return same and all(corner in border for corner in corners)
+
+
+def test_query_cache(count=200, capacity=1):
+    """
+    Compare cached range queries with the tree's own answers, for exact and snapped keys,
+    before and after inserting and removing points through the cache
+    """
+    points = generate_points(np.random.uniform, count, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)
+    boundary = qt.AABB(
+        (DEFAULT_AABB_CENTER_X, DEFAULT_AABB_CENTER_Y), POINT_GEN_UPPER_BOUND/2, POINT_GEN_UPPER_BOUND/2
+    )
+
+    # nearby rectangles share a snapped key, each one is asked twice
+    sections = []
+    for _ in range(20):
+        x_min, y_min = np.random.uniform(0, 60), np.random.uniform(0, 60)
+        for _ in range(3):
+            dx, dy = np.random.uniform(0, 1, 2)
+            sections.append((x_min + dx, x_min + 30 + dx, y_min + dy, y_min + 30 + dy))
+
+    same = True
+    for quantum in (0, 5):
+        qtree = qt.BuildQuadTree(boundary, capacity, points=points, robust=True)
+        kdtree = kd.dynamic_kd_tree(points)
+        caches = ((QueryCache(qtree, quantum), qtree.query_range,
+                   lambda s: qt.AABB.from_edges(*s)),
+                  (QueryCache(kdtree, quantum), kdtree.points_inside_rect,
+                   lambda s: kd.rect(*s)))
+
+        for cache, direct, make in caches:
+            def check():
+                return all(sorted(cache.query_range(make(s))) == sorted(direct(make(s)))
+                           for s in sections + sections)
+
+            same = same and check() and cache.hits > 0
+
+            # changes made through the cache must not leave stale entries behind
+            for x_min, x_max, y_min, y_max in sections[::3]:
+                cache.insert(((x_min + x_max) / 2, (y_min + y_max) / 2))
+            for point in points[::5]:
+                same = same and cache.remove(point)
+            same = same and check()
+
+    return same
+
+
+def test_query_server(count=200, capacity=1):
+    """
+    Send concurrent queries, many of them identical, through AsyncQueryServer and compare the
+    answers with direct queries. Batches must coalesce queries but never hold more than max_pending.
+    """
+    points = generate_points(np.random.uniform, count, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)
+    boundary = qt.AABB(
+        (DEFAULT_AABB_CENTER_X, DEFAULT_AABB_CENTER_Y), POINT_GEN_UPPER_BOUND/2, POINT_GEN_UPPER_BOUND/2
+    )
+    qtree = qt.BuildQuadTree(boundary, capacity, points=points, robust=True)
+    kdtree_array = kd.build_kd_tree_array(np.array(points), capacity)
+
+    corners = np.random.uniform(0, 80, (20, 2))
+    distinct = np.column_stack((corners[:, 0], corners[:, 0] + 20, corners[:, 1], corners[:, 1] + 20))
+    rects = np.concatenate((np.repeat(distinct[:1], 100, axis=0), distinct))
+    max_pending = 16
+
+    # index wrapper recording the size of every batch the server sends
+    class Recorded:
+        def __init__(self, index):
+            self.index, self.sizes = index, []
+
+        def query_many(self, rects):
+            self.sizes.append(len(rects))
+            return server.batch_query(self.index, rects)
+
+    async def ask_all(index):
+        query_server = server.AsyncQueryServer(index, max_pending=max_pending)
+        answers = await asyncio.gather(*(query_server.query(row) for row in rects.tolist()))
+        await query_server.close()
+        return answers
+
+    same = True
+    for index in (qtree, kdtree_array):
+        recorded = Recorded(index)
+        answers, _ = measure_func("Measure AsyncQueryServer time", asyncio.run, ask_all(recorded))
+        for row, answer in zip(rects, answers):
+            _, expected = server.batch_query(index, row[None, :])
+            same = same and sorted(map(tuple, answer.tolist())) == sorted(map(tuple, expected.tolist()))
+        same = (same and sum(recorded.sizes) == len(rects) and 1 < len(recorded.sizes) < len(rects)
+                and max(recorded.sizes) <= max_pending)
+
+    return same
+
+
+def random_rects(count: int, points: list[tuple[float, float]]) -> np.ndarray:
+    """
+    (count, 4) x_min, x_max, y_min, y_max rows over the points' range, followed by one rectangle
+    missing every point, one holding all of them and one whose edges go through points
+    """
+    corners = np.random.uniform(POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND, (count, 2))
+    sizes = np.random.uniform(0, POINT_GEN_UPPER_BOUND / 2, (count, 2))
+    rects = np.column_stack((corners[:, 0], corners[:, 0] + sizes[:, 0], corners[:, 1], corners[:, 1] + sizes[:, 1]))
+    (x0, y0), (x1, y1) = points[0], points[-1]
+    special = [(-20, -10, -20, -10), (-1, 101, -1, 101), (min(x0, x1), max(x0, x1), min(y0, y1), max(y0, y1))]
+
+    return np.concatenate((rects, special))
+
+
+def test_query_many(count=200, capacity=1):
+    """
+    Compare batched range queries with the same rectangles asked one by one
+    """
+    points = generate_points(np.random.uniform, count, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)
+    boundary = qt.AABB(
+        (DEFAULT_AABB_CENTER_X, DEFAULT_AABB_CENTER_Y), POINT_GEN_UPPER_BOUND/2, POINT_GEN_UPPER_BOUND/2
+    )
+    qtree = qt.BuildQuadTree(boundary, capacity, points=points, robust=True)
+    kdtree_array = kd.build_kd_tree_array(np.array(points), capacity)
+    rects = random_rects(100, points)
+
+    (q_offsets, q_points), _ = measure_func("Measure QuadTree batched query time", qtree.query_many, rects)
+    (kd_offsets, kd_indices), _ = measure_func("Measure Array KDTree batched query time", kd.query_many, rects,
+                                               kdtree_array)
+
+    same = True
+    for i, row in enumerate(rects.tolist()):
+        q_single = qtree.query_range(qt.AABB.from_edges(*row))
+        kd_single = kd.points_inside_rect(kd.rect(*row), kdtree_array)
+        q_batched = map(tuple, q_points[q_offsets[i]:q_offsets[i + 1]].tolist())
+        kd_batched = map(tuple, kdtree_array.points[kd_indices[kd_offsets[i]:kd_offsets[i + 1]]].tolist())
+        same = same and sorted(q_batched) == sorted(q_single) and sorted(kd_batched) == sorted(kd_single)
+
+    return same and len(q_offsets) == len(kd_offsets) == len(rects) + 1
+
+
+def test_count_aggregate(count=200, capacity=1):
+    """
+    Compare count_range and aggregate_range with brute force, on uniform and clustered points
+    """
+    uniform = generate_points(np.random.uniform, count, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)
+    clustered = (generate_points(np.random.uniform, count // 2, 10, 20) +
+                 generate_points(np.random.uniform, count - count // 2, 70, 75))
+    boundary = qt.AABB(
+        (DEFAULT_AABB_CENTER_X, DEFAULT_AABB_CENTER_Y), POINT_GEN_UPPER_BOUND/2, POINT_GEN_UPPER_BOUND/2
+    )
+
+    def expected(A, weights, row):
+        x_min, x_max, y_min, y_max = row
+        inside = (x_min <= A[:, 0]) & (A[:, 0] <= x_max) & (y_min <= A[:, 1]) & (A[:, 1] <= y_max)
+        return int(inside.sum()), weights[inside]
+
+    def agrees(summary, found, weights):
+        if summary['count'] != found:
+            return False
+        if not found:
+            return summary['sum'] == 0.0 and np.isnan(summary['mean'])
+        return (np.isclose(summary['sum'], weights.sum()) and np.isclose(summary['mean'], weights.mean())
+                and summary['min'] == weights.min() and summary['max'] == weights.max())
+
+    same = True
+    for points in (uniform, clustered):
+        A = np.array(points)
+        weights = np.random.uniform(0, 10, len(A))
+        ones = np.ones(len(A))
+        qtree = qt.BuildQuadTree(boundary, capacity, points=points, robust=True)
+        qtree_weighted = qt.BulkLoadQuadTree(boundary, capacity, np.column_stack((A, weights)))
+        kdtree = kd.build_kd_tree(points)
+        # the array build permutes its input in place
+        kdtree_array = kd.build_kd_tree_array(A.copy(), capacity)
+        kdtree_weighted = kd.build_kd_tree_array(A.copy(), capacity, weights=weights)
+
+        for row in random_rects(50, points).tolist():
+            found, inside = expected(A, weights, row)
+            aabb, section = qt.AABB.from_edges(*row), kd.rect(*row)
+            same = (same and qtree.count_range(aabb) == found and kd.count_range(section, kdtree) == found
+                    and kd.count_range(section, kdtree_array) == found
+                    and kd.count_range(section, kdtree_weighted) == found
+                    and agrees(qtree.aggregate_range(aabb), found, ones[:found])
+                    and agrees(kd.aggregate_range(section, kdtree), found, ones[:found])
+                    and agrees(kd.aggregate_range(section, kdtree_array), found, ones[:found])
+                    and agrees(qtree_weighted.aggregate_range(aabb), found, inside)
+                    and agrees(kd.aggregate_range(section, kdtree_weighted), found, inside))
+
+    return bool(same)
+
+
+def test_radius(count=200, capacity=1):
+    """
+    Compare query_radius and query_radius_many with brute force
+    """
+    points = generate_points(np.random.uniform, count, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)
+    A = np.array(points)
+    boundary = qt.AABB(
+        (DEFAULT_AABB_CENTER_X, DEFAULT_AABB_CENTER_Y), POINT_GEN_UPPER_BOUND/2, POINT_GEN_UPPER_BOUND/2
+    )
+    qtree = qt.BuildQuadTree(boundary, capacity, points=points, robust=True)
+    kdtree = kd.build_kd_tree(points)
+    kdtree_array = kd.build_kd_tree_array(A.copy(), capacity)
+
+    # random circles, then a zero radius one on a point, one far outside and one holding everything
+    centers = np.concatenate((np.random.uniform(POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND, (50, 2)),
+                              [points[0], (-100, -100), (50, 50)]))
+    radii = np.concatenate((np.random.uniform(0, 30, 50), [0, 10, 100]))
+
+    (q_offsets, q_points), _ = measure_func("Measure QuadTree batched radius time", qtree.query_radius_many,
+                                            centers, radii)
+    (kd_offsets, kd_indices), _ = measure_func("Measure Array KDTree batched radius time", kd.query_radius_many,
+                                               centers, radii, kdtree_array)
+
+    same = True
+    for i, (center, radius) in enumerate(zip(map(tuple, centers.tolist()), radii.tolist())):
+        inside = ((A - center) ** 2).sum(axis=1) <= radius * radius
+        expected = sorted(map(tuple, A[inside].tolist()))
+        batched = (map(tuple, q_points[q_offsets[i]:q_offsets[i + 1]].tolist()),
+                   map(tuple, kdtree_array.points[kd_indices[kd_offsets[i]:kd_offsets[i + 1]]].tolist()))
+        single = (qtree.query_radius(center, radius), kd.query_radius(center, radius, kdtree),
+                  kd.query_radius(center, radius, kdtree_array))
+        same = same and all(sorted(found) == expected for found in batched + single)
+
+    return same
+
+
+def test_iter_range(count=200, capacity=1):
+    """
+    Compare iter_range and iter_range_chunks with brute force, an empty query included, and
+    check the chunk sizes and limits
+    """
+    points = generate_points(np.random.uniform, count, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)
+    A = np.array(points)
+    boundary = qt.AABB(
+        (DEFAULT_AABB_CENTER_X, DEFAULT_AABB_CENTER_Y), POINT_GEN_UPPER_BOUND/2, POINT_GEN_UPPER_BOUND/2
+    )
+    qtree = qt.BuildQuadTree(boundary, capacity, points=points, robust=True)
+    qtree_bulk = qt.BulkLoadQuadTree(boundary, capacity, A)
+    kdtree = kd.build_kd_tree(points)
+    kdtree_array = kd.build_kd_tree_array(A.copy(), capacity)
+    chunk_size, limit = 7, 10
+
+    same = True
+    for row in random_rects(20, points).tolist():
+        x_min, x_max, y_min, y_max = row
+        inside = (x_min <= A[:, 0]) & (A[:, 0] <= x_max) & (y_min <= A[:, 1]) & (A[:, 1] <= y_max)
+        expected = sorted(map(tuple, A[inside].tolist()))
+        aabb, section = qt.AABB.from_edges(*row), kd.rect(*row)
+
+        iterators = [(lambda tree=tree, **kwargs: tree.iter_range(aabb, **kwargs),
+                      lambda tree=tree, **kwargs: tree.iter_range_chunks(aabb, chunk_size, **kwargs))
+                     for tree in (qtree, qtree_bulk)]
+        iterators += [(lambda tree=tree, **kwargs: kd.iter_range(section, tree, **kwargs),
+                       lambda tree=tree, **kwargs: kd.iter_range_chunks(section, tree, chunk_size, **kwargs))
+                      for tree in (kdtree, kdtree_array)]
+        for iter_points, iter_chunks in iterators:
+            chunks = list(iter_chunks())
+            found = [point for chunk in chunks for point in map(tuple, chunk.tolist())]
+            limited = list(iter_points(limit=limit))
+            limited_chunks = sum(len(chunk) for chunk in iter_chunks(limit=limit))
+            same = (same and sorted(iter_points()) == expected and sorted(found) == expected
+                    and all(len(chunk) == chunk_size for chunk in chunks[:-1])
+                    and all(0 < len(chunk) <= chunk_size for chunk in chunks[-1:])
+                    and len(limited) == limited_chunks == min(limit, len(expected))
+                    and set(limited) <= set(expected))
+
+    return same
+
+
+def test_auto_index(count=200, capacity=1):
+    """
+    Whatever structure auto_index picks, its queries must match brute force, whichever way the
+    rectangle is given
+    """
+    uniform = generate_points(np.random.uniform, count, POINT_GEN_LOWER_BOUND, POINT_GEN_UPPER_BOUND)
+    clustered = (generate_points(np.random.uniform, count // 2, 10, 20) +
+                 generate_points(np.random.uniform, count - count // 2, 70, 75))
+
+    same = True
+    for points in (uniform, clustered):
+        A = np.array(points)
+        rects = random_rects(20, points)
+        # the automatic choice, then every structure forced in turn
+        choices = [()] + [(structure,) for structure in auto.STRUCTURES]
+        for structures in choices:
+            options = {'structures': structures} if structures else {}
+            index, _ = measure_func("auto_index build time", auto.auto_index, A.copy(), rects[:10], **options)
+            for row in rects.tolist():
+                x_min, x_max, y_min, y_max = row
+                inside = (x_min <= A[:, 0]) & (A[:, 0] <= x_max) & (y_min <= A[:, 1]) & (A[:, 1] <= y_max)
+                expected = sorted(map(tuple, A[inside].tolist()))
+                same = same and all(sorted(index.query_range(query)) == expected
+                                    for query in (row, kd.rect(*row), qt.AABB.from_edges(*row)))
+
+    return same
+
+
 #TODO: jk: Measure test_viss function
-functions_fast = [test_random, test_normal_dist, test_outliers]
+functions_fast = [test_random, test_normal_dist, test_outliers, test_kd_buckets, test_knn, test_linear_quadtree, test_memory,
+                  test_grow_root, test_point_lookup, test_dynamic_updates, test_persist,
+                  test_parallel_build, test_query_stats, test_polygon,
+                  test_query_cache, test_query_server, test_query_many,
+                  test_count_aggregate, test_radius, test_iter_range,
+                  test_auto_index]
 functions_slow = [test_clusters, test_cross]
 
 
@@ -264,17 +953,19 @@ def run_tests(functions: list[typing.Callable], count=DEFAULT_POINTS_COUNT, capa
     print("Tests passed:", passed, "Total tests run:", total_test_num)
 
 
-print("Testing FAST functions")
-print("&" * 35)
-for n in [1000, 10000, 20000, 50000, 100000]:
-    print("^" * 35)
-    print("Number of points:", n)
-    run_tests(functions_fast, count=n)
-
-print("Testing SLOW functions")
-print("&" * 35)
-for n in [100, 200, 500, 1000, 2000]:
-    print("^" * 35)
-    print("Number of points:", n)
-    run_tests(functions_slow, count=n)
+# reproducible numbers with medians and spreads: python benchmark.py run
+if __name__ == "__main__":
+    print("Testing FAST functions")
+    print("&" * 35)
+    for n in [1000, 10000, 20000, 50000, 100000]:
+        print("^" * 35)
+        print("Number of points:", n)
+        run_tests(functions_fast, count=n)
+
+    print("Testing SLOW functions")
+    print("&" * 35)
+    for n in [100, 200, 500, 1000, 2000]:
+        print("^" * 35)
+        print("Number of points:", n)
+        run_tests(functions_slow, count=n)
 
@@ -0,0 +1,90 @@
+import numpy as np
+
+# Streams of range queries as (count, 4) arrays of x_min, x_max, y_min, y_max rows.
+# Every rectangle is sized to hold a chosen fraction of the points (its selectivity), centred
+# on a data point for hotspots that follow the density or anywhere in the extent otherwise.
+# A Zipf law over a pool of distinct rectangles makes popular queries come back again and again.
+
+# named query mixes for the benchmark, keyword arguments of make_workload
+WORKLOADS = {
+    'tiny': {'selectivity': 0.00001},
+    'small': {'selectivity': 0.001},
+    'medium': {'selectivity': 0.01},
+    'large': {'selectivity': 0.1},
+    'huge': {'selectivity': 0.5},
+    # all sizes at once, stretched rectangles, mostly around dense areas and often repeated
+    'mixed': {'selectivity': (0.00001, 0.5), 'aspect': 10.0, 'hotspot': 0.8, 'zipf': 1.1},
+}
+
+
+def _log_uniform(value, count: int, rng: np.random.Generator) -> np.ndarray:
+    # a fixed value, or (low, high) drawn evenly on a log scale
+    if np.isscalar(value):
+        return np.full(count, float(value))
+    low, high = value
+    return np.exp(rng.uniform(np.log(low), np.log(high), count))
+
+
+def _sized_rect(points: np.ndarray, center: np.ndarray, k: int, aspect: float) -> tuple[float, float, float, float]:
+    # rectangle of the given width / height ratio around center holding k points: its half height
+    # lies between the k-th and k+1-th smallest scaled Chebyshev distance to center, halfway so
+    # that no point sits on an edge where rounding could decide whether it is found
+    width, height = np.sqrt(aspect), 1 / np.sqrt(aspect)
+    distance = np.maximum(np.abs(points[:, 0] - center[0]) / width, np.abs(points[:, 1] - center[1]) / height)
+    if k < len(distance):
+        kth, next_kth = np.partition(distance, (k - 1, k))[k - 1:k + 1]
+        scale = (kth + next_kth) / 2
+    else:
+        scale = distance.max()
+    return center[0] - scale * width, center[0] + scale * width, center[1] - scale * height, center[1] + scale * height
+
+
+def make_workload(points: np.ndarray, count: int, selectivity=0.001, aspect: float = 1.0, hotspot: float = 1.0,
+                  zipf: float = 0.0, distinct: int = None, seed: int = 0) -> np.ndarray:
+    """
+    Generate a stream of range queries over points.
+
+    :param points: (N, 2) array the queries are sized against.
+    :param count: Number of queries in the stream.
+    :param selectivity: Fraction of the points every query holds, or (low, high) to draw it log-uniformly.
+                        Points sharing a coordinate with the rectangle edge may add a few more.
+    :param aspect: Largest width / height ratio, every query draws its ratio log-uniformly
+                   between 1 / aspect and aspect.
+    :param hotspot: Fraction of the queries centred on a random data point, the rest are centred
+                    uniformly in the extent of the points.
+    :param zipf: Exponent of the Zipf law queries repeat with, 0 for no repetition.
+    :param distinct: Number of distinct queries drawn from, count by default or a tenth of it with zipf.
+    :param seed: Seed of the generator, the same seed always gives the same stream.
+    """
+    points = np.asarray(points, dtype=np.float64)[:, :2]
+    if not len(points):
+        raise ValueError("cannot size queries over an empty point set")
+
+    rng = np.random.default_rng(seed)
+    if distinct is None:
+        distinct = count if not zipf else max(1, count // 10)
+
+    ks = np.clip(np.rint(_log_uniform(selectivity, distinct, rng) * len(points)).astype(np.int64), 1, len(points))
+    aspects = np.exp(rng.uniform(-np.log(aspect), np.log(aspect), distinct))
+    centers = rng.uniform(points.min(axis=0), points.max(axis=0), (distinct, 2))
+    on_data = rng.random(distinct) < hotspot
+    centers[on_data] = points[rng.integers(0, len(points), on_data.sum())]
+    pool = np.array([_sized_rect(points, center, k, a) for center, k, a in zip(centers, ks, aspects)])
+
+    if not zipf:
+        return pool[rng.permutation(distinct)[:count]] if count <= distinct else pool[rng.integers(0, distinct, count)]
+
+    popularity = 1 / np.arange(1, distinct + 1) ** zipf
+    return pool[rng.choice(distinct, count, p=popularity / popularity.sum())]
+
+
+def generate(name: str, points: np.ndarray, count: int, seed: int) -> np.ndarray:
+    """
+    Generate one of WORKLOADS over points.
+
+    :param name: Key of WORKLOADS.
+    """
+    if name not in WORKLOADS:
+        raise ValueError(f"unknown workload {name!r}, expected one of {', '.join(WORKLOADS)}")
+
+    return make_workload(points, count, seed=seed, **WORKLOADS[name])